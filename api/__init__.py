@@ -1,17 +1,19 @@
-import aiohttp
 import jwt
 import os
 from dotenv import load_dotenv
 
+from .client import AsyncClient, Client, in_filter
+
 load_dotenv()
 
-API_URL = os.environ['API_URL']
+# The bot and scripts are configured with API_URL, the portal with RCOS_API_URL
+API_URL = os.environ.get('API_URL') or os.environ['RCOS_API_URL']
 JWT_SECRET = os.environ['POSTGREST_JWT_SECRET']
 
 # Create JSON Web Token to authenticate Postgrest
 encoded_jwt = jwt.encode({'role': 'api_user'}, JWT_SECRET,
                          algorithm='HS256')
 
-api = aiohttp.ClientSession(headers={
-    'Authorization': 'Bearer ' + encoded_jwt
-})
+# Blocking client for the portal and scripts, async client for the bot
+client = Client(API_URL, encoded_jwt)
+async_client = AsyncClient(API_URL, encoded_jwt)
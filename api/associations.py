@@ -1,27 +1,40 @@
-from typing import Any, Optional, Union
-from . import api, API_URL
+import os
+from typing import Any, Dict, List, Optional, Union
+from common.cache import TTLCache
+from . import async_client
+from .models import Association
 
-async def get_association(source_type: str, target_type: str, target_id: int):
+# Associations rarely change, so lookups are cached. Keys are
+# ('target', source_type, target_type, target_id) for single associations and
+# ('list', source_type, target_type, source_id) for lists.
+ASSOCIATION_CACHE_TTL = float(os.environ.get('ASSOCIATION_CACHE_TTL', 600))
+ASSOCIATION_CACHE_SIZE = int(os.environ.get('ASSOCIATION_CACHE_SIZE', 4096))
+association_cache = TTLCache(ASSOCIATION_CACHE_TTL, maxsize=ASSOCIATION_CACHE_SIZE)
+
+async def get_association(source_type: str, target_type: str, target_id: int) -> Association:
     '''Get a specific chat association
     
     - source_type -  'project' or 'small_group'
     - target_type - check schema
     - target_id - id of target item
     '''
-    async with api.get(API_URL + '/chat_associations', params={
+    key = ('target', source_type, target_type, str(target_id))
+    hit, association = association_cache.get(key)
+    if hit:
+        return association
+
+    association = await async_client.get('/chat_associations', params={
         'source_type': 'eq.' + source_type,
         'target_type': 'eq.' + target_type,
         'target_id': 'eq.' + str(target_id)
-    }, headers={
-        'Accept': 'application/vnd.pgrst.object+json'
-    }) as response:
-        response.raise_for_status()
-        return await response.json()
+    }, single=True, model=Association)
+    association_cache.set(key, association)
+    return association
 
-async def set_association(source_type: str, target_type: str, source_id: Any, target_id: Any):
+async def set_association(source_type: str, target_type: str, source_id: Any, target_id: Any) -> Association:
     '''Insert or update a specific chat association.'''
 
-    async with api.put(API_URL + '/chat_associations', params={
+    associations = await async_client.put('/chat_associations', params={
         'source_type': 'eq.' + source_type,
         'target_type': 'eq.' + target_type,
         'source_id': 'eq.' + str(source_id),
@@ -32,23 +45,55 @@ async def set_association(source_type: str, target_type: str, source_id: Any, ta
         'target_id': target_id
     }, headers={
         'Prefer': 'return=representation'
-    }) as response:
-        response.raise_for_status()
-        return await response.json()[0]
+    }, model=Association)
+    association = associations[0]
 
-async def list_associations(source_type: Optional[str] = None, target_type: Optional[str] = None, source_id: Optional[Any] = None):
+    # The association may have pointed at another target before and any list with
+    # this source type (or lists of any source type) may include it, so drop those
+    # and cache the new one
+    association_cache.invalidate_where(lambda key: key[1] == source_type or (key[0] == 'list' and key[1] is None))
+    association_cache.set(('target', source_type, target_type, str(target_id)), association)
+    return association
+
+async def list_associations(source_type: Optional[str] = None, target_type: Optional[str] = None, source_id: Optional[Any] = None) -> List[Association]:
     '''Search for and list associations. At least one parameter must be set.'''
     # Ensure some search keys are present
     if source_type is None and target_type is None and source_id is None:
         raise Exception('Some search parameters must be present')
-    
+
+    key = ('list', source_type, target_type, None if source_id is None else str(source_id))
+    hit, associations = association_cache.get(key)
+    if hit:
+        return associations
+
     # Only apply search params that are not-None
-    search = locals()
+    search = {'source_type': source_type, 'target_type': target_type, 'source_id': source_id}
     params = {}
-    for key in search.keys():
-        if search[key] is not None:
-            params[key] = 'eq.' + str(search[key])
+    for param in search.keys():
+        if search[param] is not None:
+            params[param] = 'eq.' + str(search[param])
+
+    associations = await async_client.get('/chat_associations', params=params, model=Association)
+    association_cache.set(key, associations)
+    return associations
+
+async def warm_associations(source_type: str) -> int:
+    '''
+    Load every association of a source type in one query and cache them for single
+    lookups and for listing by target type and/or source id.
+    Returns the number of associations loaded.
+    '''
+    associations = await async_client.get('/chat_associations', params={
+        'source_type': 'eq.' + source_type
+    }, model=Association)
 
-    async with api.get(API_URL + '/chat_associations', params=params) as response:
-        response.raise_for_status()
-        return await response.json()
\ No newline at end of file
+    lists: Dict[tuple, List[Association]] = {('list', source_type, None, None): associations}
+    for association in associations:
+        association_cache.set(('target', source_type, association.target_type, str(association.target_id)), association)
+        for target_type in (None, association.target_type):
+            for source_id in (None, str(association.source_id)):
+                if target_type is not None or source_id is not None:
+                    lists.setdefault(('list', source_type, target_type, source_id), []).append(association)
+    for key, value in lists.items():
+        association_cache.set(key, value)
+    return len(associations)
@@ -0,0 +1,265 @@
+'''PostgREST client with matching sync and async front ends.
+
+The portal and scripts use Client (requests, over the shared pooled sessions) and
+the bot uses AsyncClient (aiohttp). Both build queries and parse responses the same
+way, merge identical GET queries that are already in flight into one request, and
+can turn many single-key lookups into one `in.(...)` query. Responses are parsed
+with orjson when it is installed, and can be decoded straight into the typed
+records in api.models by passing `model=`.
+
+PostgREST docs: https://postgrest.org/en/stable/api.html
+'''
+
+import asyncio
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple, Type, Union
+
+import aiohttp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from common.breaker import breaker_for
+from common.http import CONNECT_TIMEOUT, POOL_MAXSIZE, READ_TIMEOUT, session_for
+from common.metrics import RequestTimer
+
+from .models import Record
+
+# Accept header that makes PostgREST return a single object instead of an array
+OBJECT_ACCEPT = 'application/vnd.pgrst.object+json'
+
+# Max number of keys put in one in.(...) filter to keep URLs short
+IN_CHUNK_SIZE = 100
+
+Params = Union[Dict[str, Any], Sequence[Tuple[str, Any]], None]
+
+
+def quote(value: Any) -> str:
+    '''Quote a value for use in a PostgREST filter list if it contains reserved characters.'''
+    value = str(value)
+    if any(c in value for c in ',.:()" \\'):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return value
+
+
+def in_filter(values: Iterable[Any]) -> str:
+    '''Build an `in.(...)` filter from a list of values.'''
+    return 'in.(' + ','.join(quote(value) for value in values) + ')'
+
+
+def build_params(params: Params) -> List[Tuple[str, str]]:
+    '''Normalize query parameters into a list of pairs, which allows repeated keys.'''
+    if params is None:
+        return []
+    items = params.items() if isinstance(params, dict) else params
+    return [(key, str(value)) for key, value in items]
+
+
+def build_headers(headers: Optional[Dict], single: bool) -> Dict:
+    headers = dict(headers or {})
+    if single:
+        headers['Accept'] = OBJECT_ACCEPT
+    return headers
+
+
+def query_key(path: str, params: List[Tuple[str, str]], headers: Dict) -> Hashable:
+    '''Identifies identical queries so they can be merged.'''
+    return path, tuple(sorted(params)), tuple(sorted(headers.items()))
+
+
+def decode(body: bytes, model: Optional[Type[Record]] = None) -> Any:
+    '''
+    Parse a PostgREST response body, into records of the given model if there is one.
+    Empty bodies (e.g. 204) become None.
+    '''
+    if not body:
+        return None
+    data = orjson.loads(body) if orjson is not None else json.loads(body)
+    if model is None:
+        return data
+    return model.from_rows(data) if isinstance(data, list) else model.from_row(data)
+
+
+def column_value(row: Union[Dict, Record], column: str) -> str:
+    return str(row[column] if isinstance(row, dict) else getattr(row, column))
+
+
+def chunks(values: Sequence, size: int = IN_CHUNK_SIZE) -> Iterable[Sequence]:
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def unique(values: Iterable[Any]) -> List[str]:
+    '''De-duplicate keys (as strings) while keeping their order.'''
+    return list(dict.fromkeys(str(value) for value in values))
+
+
+class Client:
+    '''Blocking PostgREST client.'''
+
+    def __init__(self, url: str, token: str):
+        self.url = url
+        self.headers = {'Authorization': 'Bearer ' + token}
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.breaker = breaker_for('postgrest')
+
+    def _send(self, method: str, path: str, params: List[Tuple[str, str]], headers: Dict, json=None):
+        with RequestTimer('postgrest', method, path) as timer:
+            response = self.breaker.call(session_for(self.url).request, method, self.url + path, params=params,
+                                         json=json, headers={**self.headers, **headers})
+            timer.status = response.status_code
+        response.raise_for_status()
+        return response
+
+    def request(self, method: str, path: str, params: Params = None, json=None,
+                headers: Optional[Dict] = None, single: bool = False, model: Optional[Type[Record]] = None) -> Any:
+        '''
+        Send a request and return the parsed response, as records of model if given.
+        Raises requests' HTTPError on failure, or UpstreamUnavailable while
+        PostgREST's circuit breaker is open.
+        '''
+        params = build_params(params)
+        headers = build_headers(headers, single)
+        if method != 'GET':
+            return decode(self._send(method, path, params, headers, json).content, model)
+
+        # Merge with an identical query that is already in flight
+        key = query_key(path, params, headers)
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+
+        if is_leader:
+            try:
+                future.set_result(self._send(method, path, params, headers))
+            except BaseException as err:
+                future.set_exception(err)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+
+        # Each caller decodes its own copy so results can be mutated safely
+        return decode(future.result().content, model)
+
+    def get(self, path: str, params: Params = None, headers: Optional[Dict] = None, single: bool = False,
+            model: Optional[Type[Record]] = None) -> Any:
+        return self.request('GET', path, params, headers=headers, single=single, model=model)
+
+    def post(self, path: str, json, params: Params = None, headers: Optional[Dict] = None,
+             model: Optional[Type[Record]] = None) -> Any:
+        return self.request('POST', path, params, json, headers, model=model)
+
+    def put(self, path: str, json, params: Params = None, headers: Optional[Dict] = None,
+            model: Optional[Type[Record]] = None) -> Any:
+        return self.request('PUT', path, params, json, headers, model=model)
+
+    def patch(self, path: str, json, params: Params = None, headers: Optional[Dict] = None,
+              model: Optional[Type[Record]] = None) -> Any:
+        return self.request('PATCH', path, params, json, headers, model=model)
+
+    def delete(self, path: str, params: Params = None, headers: Optional[Dict] = None,
+               model: Optional[Type[Record]] = None) -> Any:
+        return self.request('DELETE', path, params, headers=headers, model=model)
+
+    def get_many(self, path: str, column: str, keys: Iterable[Any], params: Params = None,
+                 model: Optional[Type[Record]] = None) -> Dict[str, Any]:
+        '''
+        Look up many rows by one column with `in.(...)` queries instead of one query
+        per key. Returns the rows keyed by that column's value (as a string).
+        '''
+        rows = {}
+        for chunk in chunks(unique(keys)):
+            for row in self.get(path, build_params(params) + [(column, in_filter(chunk))], model=model):
+                rows[column_value(row, column)] = row
+        return rows
+
+
+class AsyncClient:
+    '''Non-blocking PostgREST client for use inside an asyncio event loop.'''
+
+    def __init__(self, url: str, token: str):
+        self.url = url
+        self.headers = {'Authorization': 'Bearer ' + token}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created lazily so that it belongs to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit_per_host=POOL_MAXSIZE),
+                timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT))
+        return self._session
+
+    async def _send(self, method: str, path: str, params: List[Tuple[str, str]], headers: Dict, json=None) -> bytes:
+        with RequestTimer('postgrest', method, path) as timer:
+            async with self.session.request(method, self.url + path, params=params,
+                                            json=json, headers=headers) as response:
+                timer.status = response.status
+                response.raise_for_status()
+                return await response.read()
+
+    async def request(self, method: str, path: str, params: Params = None, json=None,
+                      headers: Optional[Dict] = None, single: bool = False, model: Optional[Type[Record]] = None) -> Any:
+        '''
+        Send a request and return the parsed response, as records of model if given.
+        Raises aiohttp's ClientResponseError on failure.
+        '''
+        params = build_params(params)
+        headers = build_headers(headers, single)
+        if method != 'GET':
+            return decode(await self._send(method, path, params, headers, json), model)
+
+        # Merge with an identical query that is already in flight
+        key = query_key(path, params, headers)
+        future = self._in_flight.get(key)
+        if future is None:
+            future = self._in_flight[key] = asyncio.ensure_future(
+                self._send(method, path, params, headers))
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return decode(await asyncio.shield(future), model)
+
+    async def get(self, path: str, params: Params = None, headers: Optional[Dict] = None, single: bool = False,
+                  model: Optional[Type[Record]] = None) -> Any:
+        return await self.request('GET', path, params, headers=headers, single=single, model=model)
+
+    async def post(self, path: str, json, params: Params = None, headers: Optional[Dict] = None,
+                   model: Optional[Type[Record]] = None) -> Any:
+        return await self.request('POST', path, params, json, headers, model=model)
+
+    async def put(self, path: str, json, params: Params = None, headers: Optional[Dict] = None,
+                  model: Optional[Type[Record]] = None) -> Any:
+        return await self.request('PUT', path, params, json, headers, model=model)
+
+    async def patch(self, path: str, json, params: Params = None, headers: Optional[Dict] = None,
+                    model: Optional[Type[Record]] = None) -> Any:
+        return await self.request('PATCH', path, params, json, headers, model=model)
+
+    async def delete(self, path: str, params: Params = None, headers: Optional[Dict] = None,
+                     model: Optional[Type[Record]] = None) -> Any:
+        return await self.request('DELETE', path, params, headers=headers, model=model)
+
+    async def get_many(self, path: str, column: str, keys: Iterable[Any], params: Params = None,
+                       model: Optional[Type[Record]] = None) -> Dict[str, Any]:
+        '''
+        Look up many rows by one column with concurrent `in.(...)` queries.
+        Returns the rows keyed by that column's value (as a string).
+        '''
+        results = await asyncio.gather(*[
+            self.get(path, build_params(params) + [(column, in_filter(chunk))], model=model)
+            for chunk in chunks(unique(keys))
+        ])
+        return {column_value(row, column): row for rows in results for row in rows}
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
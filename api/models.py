@@ -0,0 +1,129 @@
+'''Typed records for the PostgREST rows passed around the portal, bot and scripts.
+
+Records use __slots__, so they are much smaller than the dicts they are built from,
+and are checked when they are decoded: a row missing a required column fails right
+there with a RecordError naming it, not later with a KeyError somewhere else.
+Columns a record doesn't declare are ignored.
+
+`pack()` turns a record into a list of its values in field order, a compact form for
+sessions and caches, and `unpack()` turns it back. Fields must never be reordered or
+renamed in place; adding or removing one changes the packed length, so a stale packed
+record fails to unpack with a RecordError instead of filling the wrong attributes.
+'''
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, TypeVar
+
+R = TypeVar('R', bound='Record')
+
+
+class RecordError(ValueError):
+    '''Raised when a row can't be turned into a record.'''
+
+
+class Record:
+    # Columns every row must have, then columns that default to None
+    required: Tuple[str, ...] = ()
+    optional: Tuple[str, ...] = ()
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for field in self.required:
+            if field not in values:
+                raise RecordError(f'{type(self).__name__} is missing {field}')
+            setattr(self, field, values[field])
+        for field in self.optional:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def fields(cls) -> Tuple[str, ...]:
+        return cls.required + cls.optional
+
+    @classmethod
+    def from_row(cls: Type[R], row: Dict) -> R:
+        if not isinstance(row, dict):
+            raise RecordError(f'Expected a {cls.__name__} row, got {type(row).__name__}')
+        return cls(**row)
+
+    @classmethod
+    def from_rows(cls: Type[R], rows: Iterable[Dict]) -> List[R]:
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def unpack(cls: Type[R], values: List[Any]) -> R:
+        '''Rebuild a packed record. Raises RecordError if it was packed with different fields.'''
+        fields = cls.fields()
+        if len(values) != len(fields):
+            raise RecordError(f'Packed {cls.__name__} has {len(values)} values, expected {len(fields)}')
+        return cls(**dict(zip(fields, values)))
+
+    def pack(self) -> List[Any]:
+        return [getattr(self, field) for field in self.fields()]
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.fields()}
+
+    def __eq__(self, other) -> bool:
+        return type(other) is type(self) and self.pack() == other.pack()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({", ".join(f"{field}={getattr(self, field)!r}" for field in self.required)})'
+
+
+class User(Record):
+    required = ('username',)
+    optional = ('first_name', 'last_name', 'role', 'cohort', 'timezone', 'updated_at')
+    __slots__ = required + optional
+
+    username: str
+    first_name: Optional[str]
+    last_name: Optional[str]
+    role: Optional[str]
+    cohort: Optional[int]
+    timezone: Optional[str]
+    updated_at: Optional[str]
+
+
+class UserAccount(Record):
+    '''A user_accounts row, e.g. a Discord account link (type 'discord').'''
+    required = ('username', 'account_id')
+    optional = ('type', 'updated_at')
+    __slots__ = required + optional
+
+    username: str
+    account_id: str
+    type: Optional[str]
+    updated_at: Optional[str]
+
+
+class Meeting(Record):
+    required = ('meeting_id', 'type', 'start_date_time', 'end_date_time', 'is_public')
+    optional = ('title', 'location', 'agenda', 'host_username', 'updated_at')
+    __slots__ = required + optional
+
+    meeting_id: int
+    type: str
+    start_date_time: str
+    end_date_time: str
+    is_public: bool
+    title: Optional[str]
+    location: Optional[str]
+    agenda: Optional[List[str]]
+    host_username: Optional[str]
+    updated_at: Optional[str]
+
+
+class Association(Record):
+    '''A chat_associations row linking a project or small group to a Discord channel or role.'''
+    required = ('source_type', 'source_id', 'target_type', 'target_id')
+    __slots__ = required
+
+    source_type: str
+    source_id: Any
+    target_type: str
+    target_id: Any
+
+
+# Record types by name, for decoding packed records
+RECORD_TYPES: Dict[str, Type[Record]] = {
+    record_type.__name__: record_type for record_type in (User, UserAccount, Meeting, Association)
+}
@@ -1,25 +1,18 @@
 import re
-from typing import Dict
-from api import API_URL, api
+from api import async_client
+from api.models import User
 
 
-async def get_user(username: str):
+async def get_user(username: str) -> User:
     '''Get a specific user by username.'''
-    async with api.get(API_URL + '/chat_associations', params={
+    return await async_client.get('/users', params={
         'username': 'eq.' + username
-    }, headers={
-        'Accept': 'application/vnd.pgrst.object+json'
-    }) as response:
-        response.raise_for_status()
-        return await response.json()
+    }, single=True, model=User)
 
-async def get_user_from_discord_account(discord_user_id: int) -> Dict:
-    async with api.get(API_URL + '/user_accounts', params={
+async def get_user_from_discord_account(discord_user_id: int) -> User:
+    account = await async_client.get('/user_accounts', params={
         'type': 'eq.discord',
         'account_id': 'eq.' + str(discord_user_id),
         'select': 'user_accounts_pkey:users(*)'
-    }, headers={
-        'Accept': 'application/vnd.pgrst.object+json'
-    }) as response:
-        response.raise_for_status()
-        return (await response.json())['user_accounts_pkey']
\ No newline at end of file
+    }, single=True)
+    return User.from_row(account['user_accounts_pkey'])
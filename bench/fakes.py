@@ -0,0 +1,226 @@
+'''Local stand-ins for PostgREST and the Discord REST/OAuth API.
+
+They implement just enough of each API for the portal's join flow, keep their data
+in memory, and can add latency, 429s and errors to any request. Every request is
+counted by route so calls per onboarding can be reported.
+'''
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+
+class FakeServer:
+    '''
+    Serves a fake API on a local port in a background thread.
+
+    - latency - seconds added to every response
+    - rate_limit_rate - fraction of requests answered with a 429
+    - error_rate - fraction of requests answered with a 500
+    '''
+
+    def __init__(self, latency: float = 0.0, rate_limit_rate: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_method(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                status, headers, data = fake.dispatch(self.command, url.path, parse_qsl(url.query),
+                                                      self.headers, body)
+                payload = b'' if data is None else json.dumps(data).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_method
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> 'FakeServer':
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def dispatch(self, method: str, path: str, params: List[Tuple[str, str]], headers, body: bytes):
+        if self.latency:
+            time.sleep(self.latency)
+        route, handler = self.route(method, path)
+        with self.lock:
+            self.calls[route] += 1
+        if random.random() < self.rate_limit_rate:
+            return 429, {'Retry-After': '0.05'}, {'message': 'You are being rate limited.', 'retry_after': 0.05, 'global': False}
+        if random.random() < self.error_rate:
+            return 500, {}, {'message': 'Injected error'}
+        if handler is None:
+            return 404, {}, {'message': 'Not found'}
+        data = json.loads(body) if body and body.startswith(b'{') else dict(parse_qsl(body.decode()))
+        with self.lock:
+            return handler(path, dict(params), headers, data)
+
+    def route(self, method: str, path: str) -> Tuple[str, Optional[Callable]]:
+        raise NotImplementedError
+
+
+class FakePostgrest(FakeServer):
+    '''The users and user_accounts tables, filtered by eq. on username/type only.'''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.users: Dict[str, Dict] = {}
+        # (username, type) -> account
+        self.accounts: Dict[Tuple[str, str], Dict] = {}
+
+    def route(self, method, path):
+        handlers = {
+            ('GET', '/users'): self.get_users,
+            ('PUT', '/users'): self.put_user,
+            ('GET', '/user_accounts'): self.get_accounts,
+            ('PUT', '/user_accounts'): self.put_account,
+            ('DELETE', '/user_accounts'): self.delete_accounts,
+        }
+        return f'{method} {path}', handlers.get((method, path))
+
+    @staticmethod
+    def respond(rows: List[Dict], headers):
+        if 'vnd.pgrst.object' in headers.get('Accept', ''):
+            if len(rows) != 1:
+                return 406, {}, {'message': 'JSON object requested, multiple (or no) rows returned'}
+            return 200, {}, rows[0]
+        return 200, {}, rows
+
+    def get_users(self, path, params, headers, data):
+        username = params.get('username', 'eq.')[3:]
+        rows = [dict(self.users[username])] if username in self.users else []
+        if 'user_accounts(*)' in params.get('select', ''):
+            account_type = params.get('user_accounts.type', 'eq.discord')[3:]
+            for row in rows:
+                account = self.accounts.get((row['username'], account_type))
+                row['user_accounts'] = [account] if account else []
+        return self.respond(rows, headers)
+
+    def put_user(self, path, params, headers, data):
+        self.users[data['username']] = {'cohort': None, **data}
+        return 200, {}, [self.users[data['username']]]
+
+    def get_accounts(self, path, params, headers, data):
+        key = (params.get('username', 'eq.')[3:], params.get('type', 'eq.discord')[3:])
+        return self.respond([self.accounts[key]] if key in self.accounts else [], headers)
+
+    def put_account(self, path, params, headers, data):
+        self.accounts[(data['username'], data['type'])] = data
+        return 200, {}, [data]
+
+    def delete_accounts(self, path, params, headers, data):
+        account = self.accounts.pop((params.get('username', 'eq.')[3:], params.get('type', 'eq.discord')[3:]), None)
+        return 200, {}, [account] if account else []
+
+
+class FakeDiscord(FakeServer):
+    '''OAuth token exchange, the current user and guild member endpoints.'''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.members: Dict[str, Dict] = {}
+
+    def route(self, method, path):
+        parts = path.strip('/').split('/')
+        if path.endswith('/oauth2/token'):
+            return 'POST /oauth2/token', self.token
+        if path.endswith('/users/@me'):
+            return 'GET /users/@me', self.me
+        if 'members' in parts:
+            template = '/guilds/{guild_id}/members/{user_id}' + ('/roles/{role_id}' if 'roles' in parts else '')
+            return f'{method} {template}', {
+                ('PUT', False): self.add_member,
+                ('GET', False): self.get_member,
+                ('PATCH', False): self.modify_member,
+                ('DELETE', False): self.remove_member,
+                ('PUT', True): self.add_role,
+                ('DELETE', True): self.remove_role,
+            }.get((method, 'roles' in parts))
+        return f'{method} {path}', None
+
+    @staticmethod
+    def member_id(path: str) -> str:
+        parts = path.strip('/').split('/')
+        return parts[parts.index('members') + 1]
+
+    def token(self, path, params, headers, data):
+        # The code is the user id the fake user will have
+        return 200, {}, {'access_token': data['code'], 'token_type': 'Bearer', 'refresh_token': 'x', 'expires_in': 604800}
+
+    def me(self, path, params, headers, data):
+        user_id = headers['Authorization'].split(' ')[1]
+        return 200, {}, {'id': user_id, 'username': 'user' + user_id, 'discriminator': '0001', 'avatar': None}
+
+    def add_member(self, path, params, headers, data):
+        user_id = self.member_id(path)
+        if user_id in self.members:
+            return 204, {}, None
+        self.members[user_id] = {
+            'user': {'id': user_id, 'username': 'user' + user_id, 'discriminator': '0001', 'avatar': None},
+            'nick': data.get('nick'),
+            'roles': list(data.get('roles', []))
+        }
+        return 201, {}, self.members[user_id]
+
+    def get_member(self, path, params, headers, data):
+        member = self.members.get(self.member_id(path))
+        return (200, {}, member) if member else (404, {}, {'message': 'Unknown Member', 'code': 10007})
+
+    def modify_member(self, path, params, headers, data):
+        member = self.members.get(self.member_id(path))
+        if member is None:
+            return 404, {}, {'message': 'Unknown Member', 'code': 10007}
+        member.update(data)
+        return 200, {}, member
+
+    def remove_member(self, path, params, headers, data):
+        self.members.pop(self.member_id(path), None)
+        return 204, {}, None
+
+    def add_role(self, path, params, headers, data):
+        member = self.members.get(self.member_id(path))
+        role_id = path.rstrip('/').split('/')[-1]
+        if member is not None and role_id not in member['roles']:
+            member['roles'].append(role_id)
+        return 204, {}, None
+
+    def remove_role(self, path, params, headers, data):
+        member = self.members.get(self.member_id(path))
+        role_id = path.rstrip('/').split('/')[-1]
+        if member is not None and role_id in member['roles']:
+            member['roles'].remove(role_id)
+        return 204, {}, None
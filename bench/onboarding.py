@@ -0,0 +1,175 @@
+'''Benchmark the portal's join flow against local fake upstreams.
+
+Each simulated user goes through GET /join -> POST /join -> /discord/callback ->
+/onboarding/status (polled until the background job finishes) -> /joined with CAS bypassed, at each requested concurrency level. Latency percentiles,
+throughput and outbound calls per onboarding are printed and saved as JSON in
+bench/results/, and compared with the previous run.
+
+Usage: python -m bench.onboarding [--concurrency 1 8 32] [--onboardings 200]
+                                  [--latency 0.02] [--rate-limit-rate 0.01] [--error-rate 0]
+
+This drives the Flask app in-process with one thread per concurrent user, which
+stands in for a gunicorn worker running threads.
+'''
+
+import argparse
+import datetime
+import glob
+import json
+import math
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from .fakes import FakeDiscord, FakePostgrest
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+BASE_URL = 'https://localhost'
+
+SERVER_ID = '1'
+VERIFIED_ROLE_ID = '2'
+
+
+def configure_environment(postgrest: FakePostgrest, discord: FakeDiscord):
+    '''Point the portal at the fakes. Must run before portal.main is imported.'''
+    state_dir = tempfile.mkdtemp()
+    os.environ.update({
+        'RCOS_API_URL': postgrest.url,
+        'POSTGREST_JWT_SECRET': 'benchmark',
+        'DISCORD_API_BASE': discord.url + '/api',
+        'DISCORD_BOT_TOKEN': 'benchmark',
+        'DISCORD_CLIENT_ID': 'benchmark',
+        'DISCORD_CLIENT_SECRET': 'benchmark',
+        'DISCORD_REDIRECT_URI': BASE_URL + '/discord/callback',
+        'DISCORD_SERVER_ID': SERVER_ID,
+        'DISCORD_VERIFIED_ROLE_ID': VERIFIED_ROLE_ID,
+        'FLASK_SECRET_KEY': 'benchmark',
+        'SITE_TITLE': 'Benchmark',
+        # Keep the portal's logs from drowning out the report
+        'LOG_LEVEL': 'WARNING',
+        'ONBOARDING_QUEUE_PATH': os.path.join(state_dir, 'onboarding.sqlite3'),
+        'SESSION_STORE_PATH': os.path.join(state_dir, 'sessions.sqlite3'),
+    })
+    os.environ.pop('MEMBER_CACHE_URL', None)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def wait_for_onboarding(client) -> int:
+    '''Poll the onboarding job status until it finishes. Returns the last status code.'''
+    while True:
+        response = client.get('/onboarding/status', base_url=BASE_URL)
+        if response.status_code != 200 or response.get_json()['status'] in ('done', 'failed'):
+            return response.status_code
+        time.sleep(0.01)
+
+
+def onboard(app, username: str, discord_user_id: str) -> Tuple[float, bool]:
+    '''Run one user through the join flow. Returns the time taken and whether it succeeded.'''
+    client = app.test_client()
+    with client.session_transaction(base_url=BASE_URL) as session:
+        session[app.config['CAS_USERNAME_SESSION_KEY']] = username
+
+    started = time.perf_counter()
+    statuses = (
+        client.get('/join', base_url=BASE_URL).status_code,
+        client.post('/join', base_url=BASE_URL, data={
+            'first_name': 'Bench',
+            'last_name': 'Mark',
+            'graduation_year': '2024',
+            'timezone': 'America/New_York'
+        }).status_code,
+        client.get('/discord/callback', base_url=BASE_URL, query_string={'code': discord_user_id}).status_code,
+        wait_for_onboarding(client),
+        client.get('/joined', base_url=BASE_URL).status_code,
+    )
+    return time.perf_counter() - started, statuses == (200, 302, 302, 200, 200)
+
+
+def run_level(app, postgrest: FakePostgrest, discord: FakeDiscord, concurrency: int, onboardings: int) -> Dict:
+    postgrest.reset_calls()
+    discord.reset_calls()
+    users = [(f'bench{concurrency}x{i}', str(10 ** 17 + concurrency * 10 ** 6 + i)) for i in range(onboardings)]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda user: onboard(app, *user), users))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    calls = {'postgrest': dict(postgrest.calls), 'discord': dict(discord.calls)}
+    return {
+        'concurrency': concurrency,
+        'onboardings': onboardings,
+        'failures': sum(1 for _, ok in results if not ok),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'throughput': onboardings / elapsed,
+        'calls_per_onboarding': {
+            upstream: {route: count / onboardings for route, count in sorted(counts.items())}
+            for upstream, counts in calls.items()
+        },
+        'total_calls_per_onboarding': sum(sum(counts.values()) for counts in calls.values()) / onboardings
+    }
+
+
+def print_level(level: Dict, previous: Dict = None):
+    line = (f'concurrency {level["concurrency"]:>4}: p50 {level["p50"] * 1000:7.1f}ms  p95 {level["p95"] * 1000:7.1f}ms  '
+            f'p99 {level["p99"] * 1000:7.1f}ms  {level["throughput"]:7.1f} onboardings/s  '
+            f'{level["total_calls_per_onboarding"]:.2f} calls/onboarding  {level["failures"]} failures')
+    if previous is not None:
+        line += (f'  (p50 {(level["p50"] / previous["p50"] - 1) * 100:+.0f}%, '
+                 f'throughput {(level["throughput"] / previous["throughput"] - 1) * 100:+.0f}%)')
+    print(line)
+
+
+def load_previous_levels() -> Dict[int, Dict]:
+    paths = sorted(glob.glob(os.path.join(RESULTS_DIR, '*.json')))
+    if len(paths) == 0:
+        return {}
+    with open(paths[-1]) as f:
+        return {level['concurrency']: level for level in json.load(f)['levels']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the portal join flow against fake upstreams.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--onboardings', type=int, default=200, help='onboardings per concurrency level')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every upstream response')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of Discord calls answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of upstream calls answered with 500')
+    args = parser.parse_args()
+
+    postgrest = FakePostgrest(latency=args.latency, error_rate=args.error_rate).start()
+    discord = FakeDiscord(latency=args.latency, rate_limit_rate=args.rate_limit_rate,
+                          error_rate=args.error_rate).start()
+    configure_environment(postgrest, discord)
+
+    from portal.main import app
+
+    previous = load_previous_levels()
+    levels = []
+    for concurrency in args.concurrency:
+        level = run_level(app, postgrest, discord, concurrency, args.onboardings)
+        print_level(level, previous.get(concurrency))
+        levels.append(level)
+
+    postgrest.stop()
+    discord.stop()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(path, 'w') as f:
+        json.dump({'config': vars(args), 'levels': levels}, f, indent=2)
+    print(f'Saved results to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+'''An in-memory directory of RCOS users for lookup commands.
+
+Users and their Discord account links are loaded in bulk and indexed by Discord id,
+RCS id, name prefix and cohort, so `?whois` and `?find` answer without any API
+calls. Rows are kept as compact User and UserAccount records. The index is kept current with delta refreshes of only the rows updated
+since the last one, plus a periodic full resync that also drops deleted rows.
+'''
+
+import bisect
+import difflib
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Type
+
+import aiohttp
+import discord
+from discord.ext import commands, tasks
+from discord.ext.commands.context import Context
+from dotenv import load_dotenv
+
+from api import async_client
+from api.models import Record, User, UserAccount
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Seconds between delta refreshes and between full resyncs
+REFRESH_INTERVAL = int(os.environ.get('DIRECTORY_REFRESH_SECONDS', 60))
+FULL_RESYNC_INTERVAL = int(os.environ.get('DIRECTORY_FULL_RESYNC_SECONDS', 60 * 60))
+
+# Most users listed in a reply
+MAX_RESULTS = 10
+
+# Changed users applied to the name index in place; larger refreshes rebuild it
+NAME_DELTA_LIMIT = 100
+
+
+class DirectoryIndex:
+    def __init__(self):
+        # Users by username (RCS id)
+        self.users: Dict[str, User] = {}
+        self.usernames_by_discord_id: Dict[str, str] = {}
+        self.discord_ids_by_username: Dict[str, str] = {}
+        self.usernames_by_cohort: Dict[int, Set[str]] = defaultdict(set)
+        # Sorted (lowercase name, username) pairs for prefix search, rebuilt after changes
+        self.names: List[Tuple[str, str]] = []
+
+    @staticmethod
+    def name_keys(user: User) -> Set[str]:
+        '''The names a user can be found by: first, last, full name and RCS id.'''
+        first_name = (user.first_name or '').lower()
+        last_name = (user.last_name or '').lower()
+        return {key for key in (first_name, last_name, f'{first_name} {last_name}'.strip(), user.username) if key}
+
+    def add_users(self, users: Iterable[User]):
+        users = list(users)
+        if len(users) == 0:
+            return
+        # Move a few changed users within the sorted names rather than re-sorting them all
+        is_delta = len(users) <= NAME_DELTA_LIMIT
+        for user in users:
+            old_user = self.users.get(user.username)
+            if old_user is not None:
+                if old_user.cohort is not None:
+                    self.usernames_by_cohort[old_user.cohort].discard(user.username)
+                if is_delta:
+                    for key in self.name_keys(old_user):
+                        i = bisect.bisect_left(self.names, (key, user.username))
+                        if i < len(self.names) and self.names[i] == (key, user.username):
+                            del self.names[i]
+            self.users[user.username] = user
+            if user.cohort is not None:
+                self.usernames_by_cohort[user.cohort].add(user.username)
+            if is_delta:
+                for key in self.name_keys(user):
+                    bisect.insort(self.names, (key, user.username))
+        if not is_delta:
+            self.build_names()
+
+    def link_accounts(self, accounts: Iterable[UserAccount]):
+        '''Index Discord account links.'''
+        for account in accounts:
+            old_discord_id = self.discord_ids_by_username.get(account.username)
+            if old_discord_id is not None:
+                self.usernames_by_discord_id.pop(old_discord_id, None)
+            self.usernames_by_discord_id[account.account_id] = account.username
+            self.discord_ids_by_username[account.username] = account.account_id
+
+    def build_names(self):
+        self.names = sorted((key, username) for username, user in self.users.items()
+                            for key in self.name_keys(user))
+
+    def by_discord_id(self, discord_id: int) -> Optional[User]:
+        username = self.usernames_by_discord_id.get(str(discord_id))
+        return self.users.get(username) if username is not None else None
+
+    def by_username(self, username: str) -> Optional[User]:
+        return self.users.get(username.lower())
+
+    def by_cohort(self, cohort: int) -> List[User]:
+        return sorted((self.users[username] for username in self.usernames_by_cohort.get(cohort, ())),
+                      key=lambda user: user.username)
+
+    def discord_id(self, user: User) -> Optional[str]:
+        return self.discord_ids_by_username.get(user.username)
+
+    def search(self, query: str, limit: int = MAX_RESULTS) -> List[User]:
+        '''
+        Find users whose name or RCS id starts with the query, falling back to
+        close matches (for typos) when nothing does.
+        '''
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        usernames = {}
+        i = bisect.bisect_left(self.names, (query, ''))
+        while i < len(self.names) and self.names[i][0].startswith(query) and len(usernames) < limit:
+            usernames[self.names[i][1]] = None
+            i += 1
+
+        if not usernames:
+            keys = {}
+            for key, username in self.names:
+                keys.setdefault(key, username)
+            for key in difflib.get_close_matches(query, keys.keys(), n=limit):
+                usernames[keys[key]] = None
+
+        return [self.users[username] for username in usernames]
+
+
+def describe(user: User, discord_id: Optional[str]) -> str:
+    line = f'**{user.first_name or ""} {user.last_name or ""}** ({user.username})'
+    if user.cohort is not None:
+        line += f' - Class of {user.cohort + 4}'
+    if discord_id is not None:
+        line += f' - <@{discord_id}>'
+    return line
+
+
+class Directory(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.index = DirectoryIndex()
+        # Latest updated_at seen per table, using the database's clock rather than ours
+        self.last_updated_at: Dict[str, Optional[str]] = {'/users': None, '/user_accounts': None}
+        self.last_full_sync = 0.0
+        self.refresh.start()
+
+    def cog_unload(self):
+        self.refresh.cancel()
+
+    async def fetch_changed(self, path: str, params: Dict, model: Type[Record], is_full_sync: bool) -> List:
+        params = dict(params)
+        if not is_full_sync and self.last_updated_at[path] is not None:
+            params['updated_at'] = 'gt.' + self.last_updated_at[path]
+        rows = await async_client.get(path, params=params, model=model)
+        for row in rows:
+            if self.last_updated_at[path] is None or row.updated_at > self.last_updated_at[path]:
+                self.last_updated_at[path] = row.updated_at
+        return rows
+
+    @tasks.loop(seconds=REFRESH_INTERVAL)
+    async def refresh(self):
+        is_full_sync = time.monotonic() - self.last_full_sync > FULL_RESYNC_INTERVAL
+        try:
+            users = await self.fetch_changed('/users', {}, User, is_full_sync)
+            accounts = await self.fetch_changed('/user_accounts', {
+                'type': 'eq.discord',
+                'select': 'username,account_id,updated_at'
+            }, UserAccount, is_full_sync)
+        except aiohttp.ClientError as err:
+            logger.error('Failed to refresh the directory: %s', err)
+            return
+
+        if is_full_sync:
+            # Start over so deleted users and unlinked accounts are dropped
+            self.index = DirectoryIndex()
+            self.last_full_sync = time.monotonic()
+        self.index.add_users(users)
+        self.index.link_accounts(accounts)
+        if is_full_sync:
+            logger.info('Loaded %d users and %d Discord accounts into the directory', len(users), len(accounts))
+
+    def reply_lines(self, users: List[User], total: int) -> str:
+        lines = [describe(user, self.index.discord_id(user)) for user in users]
+        if total > len(users):
+            lines.append(f'...and {total - len(users)} more')
+        return '\n'.join(lines)
+
+    @commands.command()
+    async def whois(self, ctx: Context, *, query: str):
+        '''Look someone up by @mention, Discord id, RCS id or name'''
+        query = query.strip()
+        if ctx.message.mentions:
+            user = self.index.by_discord_id(ctx.message.mentions[0].id)
+        elif query.isdigit():
+            user = self.index.by_discord_id(int(query))
+        else:
+            user = self.index.by_username(query)
+            if user is None:
+                matches = self.index.search(query, limit=1)
+                user = matches[0] if matches else None
+
+        if user is None:
+            return await ctx.reply('No one found!')
+        await ctx.reply(describe(user, self.index.discord_id(user)),
+                        allowed_mentions=discord.AllowedMentions.none())
+
+    @commands.command()
+    async def find(self, ctx: Context, *, query: str):
+        '''Find people by the start of their name or RCS id (with typos), or by graduation year'''
+        query = query.strip()
+        if query.isdigit() and len(query) == 4:
+            users = self.index.by_cohort(int(query) - 4)
+        else:
+            users = self.index.search(query)
+        if not users:
+            return await ctx.reply('No one found!')
+        await ctx.reply(self.reply_lines(users[:MAX_RESULTS], len(users)),
+                        allowed_mentions=discord.AllowedMentions.none())
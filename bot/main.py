@@ -1,32 +1,49 @@
+import logging
 import os
 
-from discord.ext import commands
+import aiohttp
+import discord
+from discord.ext import commands, tasks
 from discord.ext.commands.context import Context
 from dotenv import load_dotenv
 
-load_dotenv()
+from api.associations import ASSOCIATION_CACHE_TTL, warm_associations
+from common.logs import setup_logging
+from . import server
+from .directory import Directory
+from .members import MemberCache
+from .polls import Polls
 
-bot = commands.Bot(command_prefix='?')
+load_dotenv()
+setup_logging()
+
+logger = logging.getLogger(__name__)
+
+# The members intent is needed to receive the member list and member events
+intents = discord.Intents.default()
+intents.members = True
+
+bot = commands.Bot(command_prefix='?', intents=intents)
+bot.add_cog(MemberCache(bot))
+bot.add_cog(Polls(bot))
+bot.add_cog(Directory(bot))
+bot.loop.create_task(server.serve())
+
+@tasks.loop(seconds=ASSOCIATION_CACHE_TTL / 2)
+async def warm_association_cache():
+    '''Keep project and small group associations cached so commands don't wait on the API'''
+    for source_type in ('project', 'small_group'):
+        try:
+            count = await warm_associations(source_type)
+            logger.info('Cached %d %s associations', count, source_type)
+        except aiohttp.ClientError as err:
+            logger.error('Failed to cache %s associations: %s', source_type, err)
 
 @bot.event
 async def on_ready():
-    print(f'Logged in as @{bot.user.name}: <@{bot.user.id}>')
-
-@bot.command()
-async def poll(ctx: Context, title: str, *options):
-    '''Create a poll with a title and up to 9 options'''
-    if len(options) == 0:
-        return await ctx.send_help('poll')
-    if len(options) > 9:
-        return await ctx.reply(f'Please give up to **9** options! You gave {len(options)}.')
-
-    lines = [f'Poll: **{title}**\n']
-    emojis = ['1️⃣','2️⃣','3️⃣','4️⃣','5️⃣','6️⃣','7️⃣','8️⃣','9️⃣']
-    for i in range(len(options)):
-        lines.append(f'{emojis[i]} - {options[i]}')
-    poll_message = await ctx.send('\n'.join(lines))
-    for i in range(len(options)):
-        await poll_message.add_reaction(emojis[i])
+    logger.info('Logged in as @%s: <@%s>', bot.user.name, bot.user.id)
+    if not warm_association_cache.is_running():
+        warm_association_cache.start()
 
 @bot.command()
 async def code(ctx: Context):
@@ -0,0 +1,101 @@
+'''A cache of the server's members kept current from gateway events.
+
+It is served over the bot's local HTTP endpoint so the portal can look members up
+without a Discord REST call on every visit. Members are returned in the same shape
+as Discord's Get Guild Member endpoint.
+
+Requires the privileged server members intent to be enabled for the bot.
+'''
+
+import logging
+import os
+from typing import Dict
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+from dotenv import load_dotenv
+
+from . import server
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SERVER_ID = int(os.environ['DISCORD_SERVER_ID'])
+
+
+def serialize_member(member: discord.Member) -> Dict:
+    '''Convert a member into the JSON shape the Discord API uses.'''
+    return {
+        'user': {
+            'id': str(member.id),
+            'username': member.name,
+            'discriminator': member.discriminator,
+            'avatar': member.avatar,
+            'bot': member.bot
+        },
+        'nick': member.nick,
+        # The API leaves out the @everyone role
+        'roles': [str(role.id) for role in member.roles if not role.is_default()],
+        'joined_at': member.joined_at.isoformat() if member.joined_at else None,
+        'premium_since': member.premium_since.isoformat() if member.premium_since else None
+    }
+
+
+class MemberCache(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        # Serialized members by user id
+        self.members: Dict[int, Dict] = {}
+        # Only true once the whole member list has been received
+        self.is_ready = False
+        server.app.router.add_get('/members/{user_id}', self.handle_get_member)
+
+    async def handle_get_member(self, request: web.Request) -> web.Response:
+        if not self.is_ready:
+            return web.json_response({'message': 'Member cache is still loading'}, status=503)
+        try:
+            member = self.members.get(int(request.match_info['user_id']))
+        except ValueError:
+            member = None
+        if member is None:
+            return web.json_response({'message': 'Unknown Member'}, status=404)
+        return web.json_response(member)
+
+    def set_member(self, member: discord.Member):
+        if member.guild.id == SERVER_ID:
+            self.members[member.id] = serialize_member(member)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        guild = self.bot.get_guild(SERVER_ID)
+        if guild is None:
+            logger.warning('Not in server %s, member cache disabled', SERVER_ID)
+            return
+        if not guild.chunked:
+            await guild.chunk()
+        self.members = {member.id: serialize_member(member) for member in guild.members}
+        self.is_ready = True
+        logger.info('Cached %d server members', len(self.members))
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        self.set_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        self.set_member(after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        # Username and avatar changes come as user updates
+        guild = self.bot.get_guild(SERVER_ID)
+        member = guild.get_member(after.id) if guild is not None else None
+        if member is not None:
+            self.set_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        if member.guild.id == SERVER_ID:
+            self.members.pop(member.id, None)
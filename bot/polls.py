@@ -0,0 +1,261 @@
+'''Polls whose votes are tallied live from reaction gateway events.
+
+Counts are kept in memory and updated as raw reaction add/remove events arrive, so
+results never require fetching reaction user lists from the API. They are saved to
+disk periodically so open polls survive a restart. Closed polls are forgotten after
+POLL_RETENTION_DAYS.
+'''
+
+import array
+import asyncio
+import heapq
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import discord
+from discord.ext import commands, tasks
+from discord.ext.commands.context import Context
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLL_EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣']
+
+POLL_STATE_PATH = os.environ.get('POLL_STATE_PATH', 'polls.json')
+
+# Seconds between saving changed tallies to disk
+POLL_SAVE_INTERVAL = int(os.environ.get('POLL_SAVE_INTERVAL', 60))
+
+# Days closed polls are kept (for ?results) before being forgotten
+POLL_RETENTION = float(os.environ.get('POLL_RETENTION_DAYS', 7)) * 24 * 60 * 60
+
+
+class Poll:
+    __slots__ = ('message_id', 'channel_id', 'author_id', 'title',
+                 'options', 'counts', 'closes_at', 'is_closed', 'closed_at')
+
+    def __init__(self, message_id: int, channel_id: int, title: str, options: List[str],
+                 counts: Optional[List[int]] = None, closes_at: Optional[float] = None, is_closed: bool = False,
+                 author_id: Optional[int] = None, closed_at: Optional[float] = None):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        # Who created the poll (None for polls saved before this was recorded)
+        self.author_id = author_id
+        self.title = title
+        self.options = options
+        self.counts = array.array('I', counts or [0] * len(options))
+        # Unix timestamp the poll closes at, if it has a deadline
+        self.closes_at = closes_at
+        self.is_closed = is_closed
+        # Polls saved closed without a closing time count as closed now
+        self.closed_at = closed_at if closed_at is not None or not is_closed else time.time()
+
+    def close(self):
+        self.is_closed = True
+        self.closed_at = time.time()
+
+    def vote(self, emoji: str, change: int) -> bool:
+        '''Count (+1) or uncount (-1) a vote by reaction emoji. Returns whether it was a poll option.'''
+        if self.is_closed or emoji not in POLL_EMOJIS[:len(self.options)]:
+            return False
+        i = POLL_EMOJIS.index(emoji)
+        self.counts[i] = max(self.counts[i] + change, 0)
+        return True
+
+    def results(self) -> str:
+        total = sum(self.counts)
+        lines = [f'{"Final results" if self.is_closed else "Results"} for **{self.title}** ({total} votes)\n']
+        for i, option in enumerate(self.options):
+            percent = round(100 * self.counts[i] / total) if total else 0
+            lines.append(f'{POLL_EMOJIS[i]} - {option}: **{self.counts[i]}** ({percent}%)')
+        return '\n'.join(lines)
+
+    def to_dict(self) -> Dict:
+        return {
+            'message_id': self.message_id,
+            'channel_id': self.channel_id,
+            'author_id': self.author_id,
+            'title': self.title,
+            'options': self.options,
+            'counts': self.counts.tolist(),
+            'closes_at': self.closes_at,
+            'is_closed': self.is_closed,
+            'closed_at': self.closed_at
+        }
+
+
+class PollTracker:
+    '''All tracked polls by message id, plus the latest poll per channel.'''
+
+    def __init__(self, path: str = POLL_STATE_PATH):
+        self.path = path
+        self.polls: Dict[int, Poll] = {}
+        self.latest_by_channel: Dict[int, int] = {}
+        # (closes at, message id) of open polls with a deadline, soonest first
+        self.deadlines: List[Tuple[float, int]] = []
+        # Whether anything changed since the last save
+        self.is_dirty = False
+
+    def add(self, poll: Poll):
+        self.polls[poll.message_id] = poll
+        self.latest_by_channel[poll.channel_id] = poll.message_id
+        if not poll.is_closed and poll.closes_at is not None:
+            heapq.heappush(self.deadlines, (poll.closes_at, poll.message_id))
+        self.is_dirty = True
+
+    def expired(self, now: float) -> List[Poll]:
+        '''Take the open polls whose deadline has passed.'''
+        polls = []
+        while len(self.deadlines) and self.deadlines[0][0] <= now:
+            _, message_id = heapq.heappop(self.deadlines)
+            poll = self.polls.get(message_id)
+            if poll is not None and not poll.is_closed:
+                polls.append(poll)
+        return polls
+
+    def prune(self, now: float) -> int:
+        '''Forget polls closed longer than POLL_RETENTION ago. Returns how many were.'''
+        expired = [poll for poll in self.polls.values()
+                   if poll.is_closed and poll.closed_at <= now - POLL_RETENTION]
+        for poll in expired:
+            del self.polls[poll.message_id]
+            if self.latest_by_channel.get(poll.channel_id) == poll.message_id:
+                del self.latest_by_channel[poll.channel_id]
+        if expired:
+            self.is_dirty = True
+        return len(expired)
+
+    def vote(self, message_id: int, emoji: str, change: int):
+        poll = self.polls.get(message_id)
+        if poll is not None and poll.vote(emoji, change):
+            self.is_dirty = True
+
+    def find(self, channel_id: int, message_id: Optional[int] = None) -> Optional[Poll]:
+        '''Get a poll by message id, or the latest poll in a channel.'''
+        if message_id is None:
+            message_id = self.latest_by_channel.get(channel_id)
+        return self.polls.get(message_id)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for data in json.load(f):
+                    self.add(Poll(**data))
+        except FileNotFoundError:
+            pass
+        self.is_dirty = False
+
+    def save(self):
+        # Write to a temporary file first so a crash can't leave a half-written file
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump([poll.to_dict() for poll in self.polls.values()], f)
+        os.replace(self.path + '.tmp', self.path)
+        self.is_dirty = False
+
+
+class Polls(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.tracker = PollTracker()
+        self.tracker.load()
+        self.save_polls.start()
+        self.close_expired_polls.start()
+
+    def cog_unload(self):
+        self.save_polls.cancel()
+        self.close_expired_polls.cancel()
+        self.tracker.save()
+
+    async def add_reactions(self, message: discord.Message, emojis: List[str]):
+        '''
+        Add reactions one after another in the background. discord.py waits for the
+        reaction bucket to have room before each one, so this never hits a 429 and
+        the command doesn't have to wait for it.
+        '''
+        for emoji in emojis:
+            await message.add_reaction(emoji)
+
+    async def create_poll(self, ctx: Context, title: str, options: List[str], minutes: Optional[float] = None):
+        if len(options) == 0:
+            return await ctx.send_help(ctx.command)
+        if len(options) > len(POLL_EMOJIS):
+            return await ctx.reply(f'Please give up to **{len(POLL_EMOJIS)}** options! You gave {len(options)}.')
+
+        lines = [f'Poll: **{title}**\n']
+        for i in range(len(options)):
+            lines.append(f'{POLL_EMOJIS[i]} - {options[i]}')
+        if minutes is not None:
+            lines.append(f'\nCloses in {minutes:g} minutes.')
+        poll_message = await ctx.send('\n'.join(lines))
+
+        self.tracker.add(Poll(poll_message.id, ctx.channel.id, title, list(options),
+                              closes_at=time.time() + minutes * 60 if minutes is not None else None,
+                              author_id=ctx.author.id))
+        asyncio.ensure_future(self.add_reactions(
+            poll_message, POLL_EMOJIS[:len(options)]))
+
+    async def close_poll(self, poll: Poll):
+        poll.close()
+        self.tracker.is_dirty = True
+        channel = self.bot.get_channel(poll.channel_id)
+        if channel is not None:
+            await channel.send(poll.results())
+
+    @commands.command()
+    async def poll(self, ctx: Context, title: str, *options):
+        '''Create a poll with a title and up to 9 options'''
+        await self.create_poll(ctx, title, options)
+
+    @commands.command()
+    async def timedpoll(self, ctx: Context, minutes: float, title: str, *options):
+        '''Create a poll that closes after some minutes with a title and up to 9 options'''
+        await self.create_poll(ctx, title, options, minutes)
+
+    @commands.command()
+    async def results(self, ctx: Context, message_id: Optional[int] = None):
+        '''Show the results of a poll (the replied to one or latest in this channel by default)'''
+        if message_id is None and ctx.message.reference is not None:
+            message_id = ctx.message.reference.message_id
+        poll = self.tracker.find(ctx.channel.id, message_id)
+        if poll is None:
+            return await ctx.reply('No poll found!')
+        await ctx.reply(poll.results())
+
+    @commands.command()
+    async def close(self, ctx: Context, message_id: Optional[int] = None):
+        '''Close a poll and show its final results (the replied to one or latest in this channel by default)'''
+        if message_id is None and ctx.message.reference is not None:
+            message_id = ctx.message.reference.message_id
+        poll = self.tracker.find(ctx.channel.id, message_id)
+        if poll is None or poll.is_closed:
+            return await ctx.reply('No open poll found!')
+        if ctx.author.id != poll.author_id and not ctx.channel.permissions_for(ctx.author).manage_messages:
+            return await ctx.reply('Only the creator of the poll or moderators can close it!')
+        await self.close_poll(poll)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if payload.user_id != self.bot.user.id:
+            self.tracker.vote(payload.message_id, str(payload.emoji), 1)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        if payload.user_id != self.bot.user.id:
+            self.tracker.vote(payload.message_id, str(payload.emoji), -1)
+
+    @tasks.loop(seconds=POLL_SAVE_INTERVAL)
+    async def save_polls(self):
+        self.tracker.prune(time.time())
+        if self.tracker.is_dirty:
+            self.tracker.save()
+
+    @tasks.loop(seconds=5)
+    async def close_expired_polls(self):
+        for poll in self.tracker.expired(time.time()):
+            await self.close_poll(poll)
+
+    @close_expired_polls.before_loop
+    async def before_close_expired_polls(self):
+        await self.bot.wait_until_ready()
@@ -0,0 +1,37 @@
+'''The bot's local HTTP endpoint.
+
+Serves the member cache to the portal and outbound call metrics in the Prometheus
+text format. Cogs add their routes to `app` before the bot starts.
+'''
+
+import logging
+import os
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from common.metrics import CONTENT_TYPE, registry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Where the endpoint listens. Keep this on loopback, it's not authenticated.
+BOT_HTTP_HOST = os.environ.get('BOT_HTTP_HOST', '127.0.0.1')
+BOT_HTTP_PORT = int(os.environ.get('BOT_HTTP_PORT', 8765))
+
+app = web.Application()
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+app.router.add_get('/metrics', handle_metrics)
+
+
+async def serve() -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, BOT_HTTP_HOST, BOT_HTTP_PORT).start()
+    logger.info('Serving on %s:%d', BOT_HTTP_HOST, BOT_HTTP_PORT)
+    return runner
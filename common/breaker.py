@@ -0,0 +1,181 @@
+'''Circuit breakers and concurrency limits for outbound calls, one per upstream.
+
+A breaker watches the outcome of the last calls to its upstream. Once enough of
+them fail (connection errors, timeouts and 5xx responses) or are slow, it opens and
+calls fail immediately with UpstreamUnavailable instead of tying up a worker
+waiting on an upstream that is struggling. After a cool-down a single trial call
+is let through, and the breaker closes again if it succeeds.
+
+Each breaker also bounds how many calls may be in flight to its upstream at once;
+calls that can't get a slot quickly are shed the same way.
+'''
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+import requests
+from dotenv import load_dotenv
+
+from .metrics import registry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Outcomes remembered, and how many are needed before the breaker can open
+WINDOW = int(os.environ.get('BREAKER_WINDOW', 20))
+MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 10))
+
+# Fraction of remembered calls that failed, or took longer than SLOW_CALL_SECONDS,
+# at which the breaker opens
+ERROR_THRESHOLD = float(os.environ.get('BREAKER_ERROR_THRESHOLD', 0.5))
+SLOW_CALL_THRESHOLD = float(os.environ.get('BREAKER_SLOW_CALL_THRESHOLD', 0.5))
+SLOW_CALL_SECONDS = float(os.environ.get('BREAKER_SLOW_CALL_SECONDS', 2.0))
+
+# Seconds an open breaker waits before letting a trial call through
+OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 30))
+
+# Calls in flight per upstream (per process), and seconds a call waits for a slot
+MAX_CONCURRENCY = int(os.environ.get('BREAKER_MAX_CONCURRENCY', 50))
+QUEUE_TIMEOUT = float(os.environ.get('BREAKER_QUEUE_TIMEOUT', 0.5))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+upstream_rejected = registry.counter(
+    'upstream_rejected_total', 'Outbound calls failed fast by circuit breakers or concurrency limits',
+    ['upstream', 'reason'])
+
+
+class UpstreamUnavailable(Exception):
+    '''Raised instead of calling an upstream whose breaker is open or that is saturated.'''
+
+    def __init__(self, upstream: str, reason: str, retry_after: float):
+        super().__init__(f'{upstream} is unavailable ({reason})')
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, upstream: str):
+        self.upstream = upstream
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # (failed, slow) of the most recent calls
+        self.outcomes = deque(maxlen=WINDOW)
+        self.is_trial_running = False
+        self.slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def reject(self, reason: str, retry_after: float):
+        upstream_rejected.inc(self.upstream, reason)
+        raise UpstreamUnavailable(self.upstream, reason, retry_after)
+
+    def before_call(self) -> bool:
+        '''Check that a call may go ahead. Returns whether it is the trial call.'''
+        with self._lock:
+            if self.state == OPEN:
+                retry_after = self.opened_at + OPEN_SECONDS - time.monotonic()
+                if retry_after > 0:
+                    self.reject('open', retry_after)
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self.is_trial_running:
+                    self.reject('open', OPEN_SECONDS)
+                self.is_trial_running = True
+                return True
+            return False
+
+    def after_call(self, is_trial: bool, failed: bool, slow: bool):
+        with self._lock:
+            if is_trial:
+                self.is_trial_running = False
+                if failed:
+                    self.trip()
+                else:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                return
+
+            self.outcomes.append((failed, slow))
+            if self.state == CLOSED and len(self.outcomes) >= MIN_CALLS:
+                failures = sum(1 for failed, _ in self.outcomes if failed)
+                slow_calls = sum(1 for _, slow in self.outcomes if slow)
+                if (failures / len(self.outcomes) >= ERROR_THRESHOLD
+                        or slow_calls / len(self.outcomes) >= SLOW_CALL_THRESHOLD):
+                    self.trip()
+
+    def trip(self):
+        if self.state != OPEN:
+            logger.warning('Circuit breaker for %s opened', self.upstream)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def call(self, send: Callable, *args, **kwargs):
+        '''
+        Make an outbound call through the breaker. Raises UpstreamUnavailable without
+        calling if the breaker is open or the upstream has too many calls in flight.
+        '''
+        is_trial = self.before_call()
+        if not self.slots.acquire(timeout=QUEUE_TIMEOUT):
+            if is_trial:
+                with self._lock:
+                    self.is_trial_running = False
+            self.reject('saturated', QUEUE_TIMEOUT)
+
+        with self._lock:
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            response = send(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.after_call(is_trial, True, time.monotonic() - started > SLOW_CALL_SECONDS)
+            raise
+        except BaseException:
+            # Not the upstream's fault
+            self.after_call(is_trial, False, False)
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+        self.after_call(is_trial, getattr(response, 'status_code', 200) >= 500,
+                        time.monotonic() - started > SLOW_CALL_SECONDS)
+        return response
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'calls': len(self.outcomes),
+                'failures': sum(1 for failed, _ in self.outcomes if failed),
+                'slow_calls': sum(1 for _, slow in self.outcomes if slow),
+                'in_flight': self.in_flight,
+                'retry_after': max(self.opened_at + OPEN_SECONDS - time.monotonic(), 0) if self.state == OPEN else 0
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(upstream: str) -> CircuitBreaker:
+    '''Get the process-wide breaker of an upstream, creating it on first use.'''
+    with _breakers_lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(upstream)
+        return _breakers[upstream]
+
+
+def breaker_statuses() -> Dict[str, Dict]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.upstream: breaker.status() for breaker in breakers}
@@ -0,0 +1,57 @@
+'''A small thread-safe in-process cache with per-entry expiry and LRU eviction.'''
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    '''
+    Remembers values for `ttl` seconds. Lookups that found nothing (None) are
+    cached too, for `negative_ttl` seconds, so repeated misses don't hit the
+    upstream every time. If `maxsize` is given, the least recently used entries
+    are evicted to stay within it.
+    '''
+
+    def __init__(self, ttl: float, negative_ttl: Optional[float] = None, maxsize: Optional[int] = None):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        '''Returns (hit, value) so that cached None values can be told apart from misses.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key: Hashable, value: Any, is_negative: bool = False):
+        ttl = self.negative_ttl if is_negative else self.ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]):
+        '''Remove every entry whose key matches.'''
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
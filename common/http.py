@@ -0,0 +1,60 @@
+'''Shared HTTP transport for outbound calls to Discord, PostgREST and webhooks.
+
+Sessions are created once per host and live for the whole process, so a gunicorn
+worker keeps its keep-alive connections warm across requests instead of paying
+for a new TCP+TLS handshake on every call. Every request gets a timeout unless
+one is given explicitly.
+'''
+
+import os
+import threading
+from typing import Dict
+from urllib.parse import urlsplit
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+load_dotenv()
+
+# Number of hosts whose pools are kept and the number of connections kept per host
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+
+# Seconds to wait for a connection to open and for a response to arrive
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+
+
+class TimeoutSession(requests.Session):
+    '''A requests Session that applies a default timeout to every request.'''
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_sessions: Dict[str, TimeoutSession] = {}
+_sessions_lock = threading.Lock()
+
+
+def session_for(url: str) -> TimeoutSession:
+    '''
+    Get the shared session for the host of a URL, creating it on first use.
+    Sessions are created lazily so each gunicorn worker gets its own after forking.
+    '''
+    parts = urlsplit(url)
+    origin = f'{parts.scheme}://{parts.netloc}'
+    with _sessions_lock:
+        if origin not in _sessions:
+            session = TimeoutSession()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                  pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[origin] = session
+        return _sessions[origin]
@@ -0,0 +1,171 @@
+'''Shared logging setup for the portal, bot and scripts.
+
+Records are put on an in-memory queue and formatted and written by a background
+thread, so the code that logs never waits on formatting or output. Each record is
+written as one JSON object per line (or as plain text with LOG_FORMAT=text), with
+secrets such as tokens and client secrets redacted. Repeated info and debug
+messages are sampled: after LOG_SAMPLE_BURST records with the same message
+template in a LOG_SAMPLE_INTERVAL, the rest are dropped and counted on the next
+one let through. Warnings and errors are never sampled.
+
+Modules log through `logging.getLogger(__name__)` with %-style arguments, so the
+message template identifies repeated messages and formatting happens off the
+calling thread.
+'''
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from .metrics import registry
+
+load_dotenv()
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+
+# Records waiting to be written; more than this are dropped rather than blocking
+QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+SAMPLE_BURST = int(os.environ.get('LOG_SAMPLE_BURST', 20))
+SAMPLE_INTERVAL = float(os.environ.get('LOG_SAMPLE_INTERVAL', 60))
+
+# Environment variables whose values never appear in logs
+SECRET_ENV_VARS = ('DISCORD_BOT_TOKEN', 'DISCORD_CLIENT_SECRET', 'POSTGREST_JWT_SECRET',
+                   'FLASK_SECRET_KEY', 'MEETING_WEBHOOK_URL', 'INTERNAL_STATUS_TOKEN')
+
+REDACTED = '[REDACTED]'
+
+log_records_dropped = registry.counter(
+    'log_records_dropped_total', 'Log records dropped because the log queue was full', [])
+
+SECRET_PATTERNS = [
+    # Authorization header values
+    (re.compile(r'\b(Bot|Bearer) [A-Za-z0-9._~+/=-]+'), r'\1 ' + REDACTED),
+    # key=value, key: value and 'key': 'value' pairs for secret keys
+    (re.compile(r'''(['"]?\b(?:client_secret|access_token|refresh_token|token|password|secret)['"]?\s*[:=]\s*['"]?)[^'"\s,&}]+''',
+                re.IGNORECASE), r'\1' + REDACTED),
+    # OAuth authorization codes in query strings and form bodies. Not `code` in
+    # general, since PostgREST and Discord error bodies have error codes under it.
+    (re.compile(r'''((?:^|[?&\s])code=)[^'"\s&]+'''), r'\1' + REDACTED),
+    # JSON Web Tokens
+    (re.compile(r'\beyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+'), REDACTED),
+    # Webhook URLs carry their token in the path
+    (re.compile(r'(/api/webhooks/\d+/)[A-Za-z0-9_-]+'), r'\1' + REDACTED),
+]
+
+
+def redact(text: str) -> str:
+    for name in SECRET_ENV_VARS:
+        value = os.environ.get(name)
+        if value and len(value) >= 8:
+            text = text.replace(value, REDACTED)
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    '''Let through at most SAMPLE_BURST info/debug records per message template per interval.'''
+
+    def __init__(self, burst: int = SAMPLE_BURST, interval: float = SAMPLE_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # (logger, template) -> (window start, records seen, records dropped)
+        self.windows: Dict[Tuple[str, str], List] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] > self.interval:
+                dropped = window[2] if window is not None else 0
+                window = self.windows[key] = [now, 0, 0]
+                if dropped:
+                    record.sampled_out = dropped
+            window[1] += 1
+            if window[1] > self.burst:
+                window[2] += 1
+                return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'message': redact(record.getMessage())
+        }
+        if getattr(record, 'sampled_out', None):
+            entry['sampled_out'] = record.sampled_out
+        if record.exc_info:
+            entry['exception'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        if getattr(record, 'sampled_out', None):
+            text += f' ({record.sampled_out} similar messages dropped)'
+        return redact(text)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    '''Puts records on the queue as they are, leaving all formatting to the listener thread.'''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT):
+    '''Send all logging through the background writer. Safe to call more than once.'''
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if log_format == 'text' else JsonFormatter())
+    log_queue = queue.Queue(QUEUE_SIZE)
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+    # Write out whatever is still queued on exit
+    atexit.register(_listener.stop)
+
+    handler = BackgroundQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,150 @@
+'''In-process metrics for outbound calls, rendered in the Prometheus text format.
+
+Calls are labelled by route template (e.g. /guilds/{guild_id}/members/{user_id}) or
+PostgREST table rather than raw URL, so the number of series stays small.
+
+Prometheus docs: https://prometheus.io/docs/instrumenting/exposition_formats/
+'''
+
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: Sequence[str]):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value:g}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, label_names: Sequence[str],
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # Labels -> (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts, total, count = self._values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    bucket_labels = format_labels(self.label_names, labels, 'le="%g"' % bound)
+                    lines.append(f'{self.name}_bucket{bucket_labels} {bucket_count}')
+                bucket_labels = format_labels(self.label_names, labels, 'le="+Inf"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {count}')
+                lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total:g}')
+                lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, description: str, label_names: Sequence[str]) -> Counter:
+        metric = Counter(name, description, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, description: str, label_names: Sequence[str],
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, description, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+upstream_requests = registry.counter(
+    'upstream_requests_total', 'Outbound requests by upstream, method, route and response status',
+    ['upstream', 'method', 'route', 'status'])
+upstream_request_duration = registry.histogram(
+    'upstream_request_duration_seconds', 'Time spent waiting on outbound requests',
+    ['upstream', 'method', 'route'])
+upstream_rate_limit_wait = registry.histogram(
+    'upstream_rate_limit_wait_seconds', 'Time outbound requests spent queued for rate limits',
+    ['upstream', 'method', 'route'])
+
+
+def observe_request(upstream: str, method: str, route: str, status, seconds: float):
+    '''Record one outbound request. status is the response status or "error" if none came.'''
+    upstream_requests.inc(upstream, method, route, str(status))
+    upstream_request_duration.observe(seconds, upstream, method, route)
+
+
+def observe_rate_limit_wait(upstream: str, method: str, route: str, seconds: float):
+    upstream_rate_limit_wait.observe(seconds, upstream, method, route)
+
+
+class RequestTimer:
+    '''
+    Times an outbound request and records it on exit. Set `status` once a response
+    arrives; if the block raises before that, the request is recorded as an error.
+
+        with RequestTimer('discord', 'GET', '/users/@me') as timer:
+            response = session.get(url)
+            timer.status = response.status_code
+    '''
+
+    def __init__(self, upstream: str, method: str, route: str):
+        self.upstream = upstream
+        self.method = method
+        self.route = route
+        self.status = 'error'
+
+    def __enter__(self) -> 'RequestTimer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_request(self.upstream, self.method, self.route, self.status,
+                        time.perf_counter() - self.started)
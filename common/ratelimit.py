@@ -0,0 +1,128 @@
+'''Client side pacing for the Discord REST API rate limits.
+
+Discord groups routes into buckets and reports the state of each bucket on every
+response through the X-RateLimit-* headers. The RateLimiter below remembers that
+state so calls can be held back *before* a bucket runs dry instead of finding out
+from a 429 after the fact.
+
+Discord docs: https://discord.com/developers/docs/topics/rate-limits
+'''
+
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class Bucket:
+    '''The last known state of a single rate limit bucket.'''
+
+    def __init__(self):
+        # Held by whichever call is currently waiting on / using the bucket,
+        # so calls sharing a bucket are let through one at a time in order
+        self.queue = threading.Lock()
+        self.limit: Optional[int] = None
+        # None means unknown (no response seen yet), so the call is let through
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+
+
+class RateLimiter:
+    '''
+    Tracks Discord rate limit buckets and the global rate limit.
+
+    Routes are identified by a key (method + path template) and a major parameter
+    (guild, channel or webhook id). Discord reports which bucket a route belongs to
+    through the X-RateLimit-Bucket header, and different routes may share one.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Route key -> bucket hash reported by Discord
+        self._bucket_hashes: Dict[str, str] = {}
+        self._buckets: Dict[Tuple[str, str], Bucket] = {}
+        self._global_reset_at = 0.0
+
+    def _get_bucket(self, key: str, major: str) -> Bucket:
+        with self._lock:
+            bucket_id = (self._bucket_hashes.get(key, key), major)
+            if bucket_id not in self._buckets:
+                self._buckets[bucket_id] = Bucket()
+            return self._buckets[bucket_id]
+
+    def _delay(self, bucket: Bucket) -> float:
+        '''How long a call on this bucket must still wait.'''
+        with self._lock:
+            now = time.monotonic()
+            delay = self._global_reset_at - now
+            if bucket.reset_at <= now and bucket.limit is not None:
+                # Window has passed, the bucket is full again
+                bucket.remaining = bucket.limit
+            elif bucket.remaining is not None and bucket.remaining <= 0:
+                delay = max(delay, bucket.reset_at - now)
+            return max(delay, 0.0)
+
+    def acquire(self, key: str, major: str = '') -> float:
+        '''
+        Block until a call on the route may be sent without exceeding its bucket
+        or the global limit. Reserves one call from the bucket.
+        Returns the number of seconds spent waiting.
+        '''
+        started = time.monotonic()
+        bucket = self._get_bucket(key, major)
+        with bucket.queue:
+            delay = self._delay(bucket)
+            while delay > 0:
+                time.sleep(delay)
+                delay = self._delay(bucket)
+            with self._lock:
+                if bucket.remaining is not None:
+                    bucket.remaining -= 1
+        return time.monotonic() - started
+
+    def update(self, key: str, major: str, headers) -> None:
+        '''Record the bucket state reported in a response's headers.'''
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash:
+            with self._lock:
+                self._bucket_hashes[key] = bucket_hash
+        bucket = self._get_bucket(key, major)
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is None or reset_after is None:
+            return
+        with self._lock:
+            bucket.limit = int(headers.get('X-RateLimit-Limit', remaining))
+            # Trust the lower of our own count and Discord's, since calls that
+            # were reserved may still be in flight
+            if bucket.remaining is None or bucket.reset_at <= time.monotonic():
+                bucket.remaining = int(remaining)
+            else:
+                bucket.remaining = min(bucket.remaining, int(remaining))
+            bucket.reset_at = time.monotonic() + float(reset_after)
+
+    def rate_limited(self, key: str, major: str, response) -> float:
+        '''
+        Record a 429 response so that other calls hold back too.
+        Returns how many seconds to wait before retrying.
+        '''
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        retry_after = float(response.headers.get(
+            'Retry-After', body.get('retry_after', 1)))
+        is_global = body.get('global', False) or response.headers.get(
+            'X-RateLimit-Global') == 'true'
+
+        reset_at = time.monotonic() + retry_after
+        if is_global:
+            with self._lock:
+                self._global_reset_at = max(self._global_reset_at, reset_at)
+        else:
+            self.update(key, major, response.headers)
+            bucket = self._get_bucket(key, major)
+            with self._lock:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, reset_at)
+        return retry_after
@@ -0,0 +1,15 @@
+'''gunicorn settings for the portal, loaded automatically from the working directory.
+
+gevent workers let one process hold many requests that are waiting on Discord or
+PostgREST: gevent patches sockets, sleeps and threads, so a request blocked on an
+upstream call yields to the others instead of pinning the worker.
+'''
+
+import os
+
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Concurrent requests each worker may hold
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 500))
+# Longer than the slowest upstream call including retries
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
@@ -0,0 +1,107 @@
+'''Static assets served with content-hashed names and precompressed bodies.
+
+Every file in portal/static is read, hashed and compressed (gzip, and brotli when
+the brotli package is installed) once when the portal starts. Templates link to
+them with `asset_url('css/portal.css')`, which gives a name like
+`css/portal.3f2a9c1b7d0e.css`. Since that name changes whenever the file does,
+hashed URLs can be cached by browsers for a year. Every response has an ETag so
+revalidations get a 304.
+'''
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, Optional
+
+from flask import Flask, Response, abort, request, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+
+# Cache-Control for hashed names, which never change, and for plain names, which can
+HASHED_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+PLAIN_CACHE_CONTROL = 'public, no-cache'
+
+# Smaller files aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+
+
+class Asset:
+    __slots__ = ('name', 'hashed_name', 'mimetype', 'etag', 'bodies')
+
+    def __init__(self, name: str, content: bytes):
+        self.name = name
+        digest = hashlib.sha256(content).hexdigest()
+        root, ext = os.path.splitext(name)
+        self.hashed_name = f'{root}.{digest[:12]}{ext}'
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.etag = digest[:32]
+        # Body by content encoding, '' being uncompressed
+        self.bodies: Dict[str, bytes] = {'': content}
+        if len(content) >= MIN_COMPRESS_SIZE:
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(content)
+            self.bodies['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+
+    def encoding_for(self, accept_encoding: str) -> str:
+        '''The smallest encoding the client accepts.'''
+        accepted = {part.split(';')[0].strip() for part in accept_encoding.split(',')}
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.bodies:
+                return encoding
+        return ''
+
+
+class AssetManifest:
+    def __init__(self, directory: str = STATIC_DIR):
+        self.assets: Dict[str, Asset] = {}
+        # Both hashed and plain names -> asset
+        self.by_url_name: Dict[str, Asset] = {}
+        for root, _, files in os.walk(directory):
+            for file in files:
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    asset = Asset(name, f.read())
+                self.assets[name] = asset
+                self.by_url_name[name] = asset
+                self.by_url_name[asset.hashed_name] = asset
+
+    def url(self, name: str) -> str:
+        '''URL of an asset by its plain name, for templates.'''
+        return url_for('asset', filename=self.assets[name].hashed_name)
+
+    def serve(self, filename: str) -> Response:
+        asset = self.by_url_name.get(filename)
+        if asset is None:
+            abort(404)
+
+        encoding = asset.encoding_for(request.headers.get('Accept-Encoding', ''))
+        # Each encoding is a different representation so it needs its own ETag
+        etag = asset.etag + ('-' + encoding if encoding else '')
+        response = Response(mimetype=asset.mimetype)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = HASHED_CACHE_CONTROL if filename == asset.hashed_name else PLAIN_CACHE_CONTROL
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        if etag in request.if_none_match:
+            response.status_code = 304
+            return response
+
+        response.set_data(asset.bodies[encoding])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def init_assets(app: Flask, directory: Optional[str] = STATIC_DIR) -> AssetManifest:
+    '''Load the assets and add the /static route and the asset_url template global.'''
+    manifest = AssetManifest(directory)
+    app.add_url_rule('/static/<path:filename>', 'asset', manifest.serve)
+    app.add_template_global(manifest.url, 'asset_url')
+    return manifest
@@ -4,15 +4,24 @@ Only a small subset of API endpoints are accounted for here.
 Based on the Discord API Documentation https://discord.com/developers/docs/intro
 '''
 
+import logging
 import os
-from typing import Dict
+import time
+from typing import Dict, Iterator, List, Optional
 
 import requests
 from dotenv import load_dotenv
 
+from common.breaker import breaker_for
+from common.http import session_for
+from common.metrics import RequestTimer, observe_rate_limit_wait
+from common.ratelimit import RateLimiter
+
 load_dotenv()
 
-API_BASE = 'https://discordapp.com/api'
+logger = logging.getLogger(__name__)
+
+API_BASE = os.environ.get('DISCORD_API_BASE', 'https://discordapp.com/api')
 
 # Environment variables (all required)
 BOT_TOKEN = os.environ.get('DISCORD_BOT_TOKEN')
@@ -31,6 +40,83 @@ HEADERS = {
 # The url users are redirected to to initiate the OAuth2 flow
 OAUTH_URL = f'https://discord.com/api/oauth2/authorize?client_id={CLIENT_ID}&redirect_uri={REDIRECT_URI}&response_type=code&scope=guilds.join%20identify'
 
+# The bot's member cache (bot/members.py), checked before asking the API for a member
+MEMBER_CACHE_URL = os.environ.get('MEMBER_CACHE_URL')
+
+# Seconds to wait for the member cache before falling back to the API
+MEMBER_CACHE_TIMEOUT = 0.5
+
+# How many times a call is retried after being rate limited (429)
+MAX_RATE_LIMIT_RETRIES = 3
+
+# Shared by every call made with the bot token
+rate_limiter = RateLimiter()
+
+breaker = breaker_for('discord')
+
+
+class Route:
+    '''
+    A Discord API endpoint. The path is a template so that calls can be grouped
+    into rate limit buckets by route rather than by raw URL, e.g.
+    Route('GET', '/guilds/{guild_id}/members/{user_id}', guild_id=..., user_id=...)
+    '''
+
+    def __init__(self, method: str, path: str, **params):
+        self.method = method
+        self.path = path
+        self.url = API_BASE + path.format(**params)
+        # Discord keeps separate buckets per guild/channel/webhook
+        self.major = str(params.get('guild_id') or params.get(
+            'channel_id') or params.get('webhook_id') or '')
+
+    @property
+    def key(self) -> str:
+        return f'{self.method} {self.path}'
+
+
+def api_request(route: Route, paced: bool = True, **kwargs) -> requests.Response:
+    '''
+    Send a request to the Discord API and raise for any error status. Raises
+    UpstreamUnavailable without calling Discord while its circuit breaker is open.
+
+    Bot calls (paced=True) wait in the rate limiter's queue until their bucket has
+    room. Calls authorized with a user's OAuth token have their own per-user limits,
+    so they are only retried on a 429. The returned response has a `queue_wait`
+    attribute with the total seconds spent waiting on rate limits.
+    '''
+    kwargs.setdefault('headers', HEADERS)
+    queue_wait = 0.0
+
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        if paced:
+            queue_wait += rate_limiter.acquire(route.key, route.major)
+        with RequestTimer('discord', route.method, route.path) as timer:
+            response = breaker.call(session_for(route.url).request,
+                                    route.method, route.url, **kwargs)
+            timer.status = response.status_code
+
+        if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+            break
+        if paced:
+            retry_after = rate_limiter.rate_limited(
+                route.key, route.major, response)
+        else:
+            retry_after = float(response.headers.get('Retry-After', 1))
+            time.sleep(retry_after)
+            queue_wait += retry_after
+        logger.info('Rate limited on %s, retrying in %.2fs', route.key, retry_after)
+
+    if paced:
+        rate_limiter.update(route.key, route.major, response.headers)
+    observe_rate_limit_wait('discord', route.method, route.path, queue_wait)
+    if queue_wait > 0:
+        logger.info('%s waited %.2fs for rate limits', route.key, queue_wait)
+
+    response.queue_wait = queue_wait
+    response.raise_for_status()
+    return response
+
 
 def get_tokens(code):
     '''
@@ -47,14 +133,13 @@ def get_tokens(code):
         'redirect_uri': REDIRECT_URI,
         'scope': 'identity guilds.join'
     }
-    print(data)
-    response = requests.post(f'{API_BASE}/oauth2/token',
-                             data=data,
-                             headers={
-                                 'Content-Type': 'application/x-www-form-urlencoded'
-                             }
-                             )
-    response.raise_for_status()
+    response = api_request(Route('POST', '/oauth2/token'),
+                           paced=False,
+                           data=data,
+                           headers={
+                               'Content-Type': 'application/x-www-form-urlencoded'
+                           }
+                           )
     tokens = response.json()
     return tokens
 
@@ -66,28 +151,72 @@ def get_user_info(access_token):
 
     Discord docs: https://discord.com/developers/docs/resources/user#get-current-user
     '''
-    response = requests.get(f'{API_BASE}/users/@me', headers={
+    response = api_request(Route('GET', '/users/@me'), paced=False, headers={
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
     )
-    response.raise_for_status()
     user = response.json()
     return user
 
 
-def get_member(user_id: str) -> Dict:
+def get_cached_member(user_id: str) -> Optional[Dict]:
+    '''
+    Look a server member up in the bot's member cache. Returns None if the cache
+    isn't configured, is unreachable or doesn't have the member.
+    '''
+    if not MEMBER_CACHE_URL:
+        return None
+    try:
+        response = session_for(MEMBER_CACHE_URL).get(f'{MEMBER_CACHE_URL}/members/{user_id}',
+                                                     timeout=MEMBER_CACHE_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+def get_member(user_id: str, use_cache: bool = True) -> Dict:
     '''
     Retreive a server member. Includes the user, their server nickname, roles, etc.
+    Checks the bot's member cache first unless told not to.
 
     Discord docs: https://discord.com/developers/docs/resources/guild#get-guild-member
     '''
-    response = requests.get(
-        f'{API_BASE}/guilds/{SERVER_ID}/members/{user_id}', headers=HEADERS)
-    response.raise_for_status()
+    if use_cache:
+        member = get_cached_member(user_id)
+        if member is not None:
+            return member
+
+    response = api_request(Route('GET', '/guilds/{guild_id}/members/{user_id}',
+                                 guild_id=SERVER_ID, user_id=user_id))
     return response.json()
 
 
+def list_members(after: str = '0', limit: int = 1000) -> List[Dict]:
+    '''
+    List up to `limit` (max 1000) server members with user ids greater than `after`,
+    in ascending id order.
+
+    Discord docs: https://discord.com/developers/docs/resources/guild#list-guild-members
+    '''
+    response = api_request(Route('GET', '/guilds/{guild_id}/members', guild_id=SERVER_ID),
+                           params={'after': after, 'limit': limit})
+    return response.json()
+
+
+def iter_members(page_size: int = 1000) -> Iterator[Dict]:
+    '''Go through every server member in ascending id order, a page at a time.'''
+    after = '0'
+    while True:
+        members = list_members(after, page_size)
+        yield from members
+        if len(members) < page_size:
+            return
+        after = members[-1]['user']['id']
+
+
 def add_user_to_server(access_token: str, user_id: str, nickname: str):
     '''
     Given a Discord user's id, add them to the Discord server with their nickname
@@ -95,15 +224,14 @@ def add_user_to_server(access_token: str, user_id: str, nickname: str):
 
     Discord docs: https://discord.com/developers/docs/resources/guild#add-guild-member
     '''
-    response = requests.put(f'{API_BASE}/guilds/{SERVER_ID}/members/{user_id}',
-                            json={
-                                'access_token': access_token,
-                                'nick': nickname,
-                                'roles': [VERIFIED_ROLE_ID],
-                            },
-                            headers=HEADERS
-                            )
-    response.raise_for_status()
+    response = api_request(Route('PUT', '/guilds/{guild_id}/members/{user_id}',
+                                 guild_id=SERVER_ID, user_id=user_id),
+                           json={
+                               'access_token': access_token,
+                               'nick': nickname,
+                               'roles': [VERIFIED_ROLE_ID],
+                           }
+                           )
     return response
 
 
@@ -113,9 +241,22 @@ def kick_member_from_server(user_id: str):
 
     Discord docs: https://discord.com/developers/docs/resources/guild#remove-guild-member
     '''
-    response = requests.delete(
-        f'{API_BASE}/guilds/{SERVER_ID}/members/{user_id}', headers=HEADERS)
-    response.raise_for_status()
+    response = api_request(Route('DELETE', '/guilds/{guild_id}/members/{user_id}',
+                                 guild_id=SERVER_ID, user_id=user_id))
+    return response
+
+
+def modify_member(user_id: str, fields: Dict):
+    '''
+    Given a Discord user's id, change any of their member fields (nick, roles, etc.)
+    on the server in a single request.
+
+    Discord docs: https://discord.com/developers/docs/resources/guild#modify-guild-member
+    '''
+    response = api_request(Route('PATCH', '/guilds/{guild_id}/members/{user_id}',
+                                 guild_id=SERVER_ID, user_id=user_id),
+                           json=fields
+                           )
     return response
 
 
@@ -125,14 +266,34 @@ def set_member_nickname(user_id: str, nickname: str):
 
     Discord docs: https://discord.com/developers/docs/resources/guild#modify-guild-member
     '''
-    response = requests.patch(f'{API_BASE}/guilds/{SERVER_ID}/members/{user_id}',
-                              json={
-                                  'nick': nickname
-                              },
-                              headers=HEADERS
-                              )
-    response.raise_for_status()
-    return response
+    return modify_member(user_id, {'nick': nickname})
+
+
+def onboard_member(access_token: str, user_id: str, nickname: str) -> Dict:
+    '''
+    Make sure a user is on the server with their nickname and the verified role,
+    using as few calls as possible.
+
+    Adding a new member (201) sets the nickname and role in the same call. If they
+    were already a member (204) those fields are ignored by Discord, so the member
+    is fetched and only the fields that differ are patched in one request.
+    Returns the fields that had to be patched.
+    '''
+    response = add_user_to_server(access_token, user_id, nickname)
+    if response.status_code == 201:
+        return {}
+
+    # The cache may lag behind by a moment, and the diff must be exact
+    member = get_member(user_id, use_cache=False)
+    changes = {}
+    if member.get('nick') != nickname:
+        changes['nick'] = nickname
+    if VERIFIED_ROLE_ID not in member['roles']:
+        changes['roles'] = member['roles'] + [VERIFIED_ROLE_ID]
+
+    if changes:
+        modify_member(user_id, changes)
+    return changes
 
 
 def add_role_to_member(user_id: str, role_id: str):
@@ -141,9 +302,8 @@ def add_role_to_member(user_id: str, role_id: str):
 
     Discord docs: https://discord.com/developers/docs/resources/guild#add-guild-member-role
     '''
-    response = requests.put(
-        f'{API_BASE}/guilds/{SERVER_ID}/members/{user_id}/roles/{role_id}', headers=HEADERS)
-    response.raise_for_status()
+    response = api_request(Route('PUT', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}',
+                                 guild_id=SERVER_ID, user_id=user_id, role_id=role_id))
     return response
 
 
@@ -153,7 +313,6 @@ def remove_role_from_member(user_id: str, role_id: str):
 
     Discord docs: https://discord.com/developers/docs/resources/guild#remove-guild-member-role
     '''
-    response = requests.delete(
-        f'{API_BASE}/guilds/{SERVER_ID}/members/{user_id}/roles/{role_id}', headers=HEADERS)
-    response.raise_for_status()
+    response = api_request(Route('DELETE', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}',
+                                 guild_id=SERVER_ID, user_id=user_id, role_id=role_id))
     return response
@@ -0,0 +1,27 @@
+'''Pieces of pages that are the same for every user, rendered once per process.'''
+
+from typing import Optional
+
+import pytz
+from markupsafe import Markup, escape
+
+from .validation import DEFAULT_TIMEZONE
+
+
+def render_timezone_options() -> str:
+    # The default is listed first
+    options = [DEFAULT_TIMEZONE] + pytz.all_timezones
+    return ''.join(f'<option value="{escape(tz)}">{escape(tz)}</option>' for tz in options)
+
+
+# ~600 options, so this is built once instead of looping over them on every /join
+TIMEZONE_OPTIONS = render_timezone_options()
+
+
+def timezone_options(selected: Optional[str] = None) -> Markup:
+    '''The <option>s of the timezone select with the user's timezone (if any) selected.'''
+    options = TIMEZONE_OPTIONS
+    if selected and selected != DEFAULT_TIMEZONE:
+        option = f'<option value="{escape(selected)}">'
+        options = options.replace(option, option[:-1] + ' selected>', 1)
+    return Markup(options)
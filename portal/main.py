@@ -1,27 +1,37 @@
+import hmac
 import os
 
-import pytz
-import requests
 from dotenv import load_dotenv
-from flask import (Flask, abort, flash, g, redirect, render_template, request,
-                   session, url_for)
+from flask import (Flask, abort, flash, g, jsonify, redirect, render_template,
+                   request, session, url_for)
 from flask_cas import CAS, login_required, logout
 from flask_talisman import Talisman
 from requests.models import HTTPError
 from werkzeug.exceptions import HTTPException
 
-from .discord import (OAUTH_URL, SERVER_ID, VERIFIED_ROLE_ID,
-                      add_role_to_member, add_user_to_server, get_member,
-                      get_tokens, get_user_info, kick_member_from_server,
-                      set_member_nickname)
-from .rcos import (delete_user_discord_account, fetch_user,
-                   fetch_user_discord_account, create_or_update_user,
-                   create_or_update_user_discord_account)
+from api.models import UserAccount
+from common.breaker import UpstreamUnavailable, breaker_statuses
+from common.logs import setup_logging
+from common.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from common.metrics import registry as metrics_registry
+
+from .assets import init_assets
+from .discord import (OAUTH_URL, SERVER_ID, get_member, get_tokens,
+                      get_user_info, kick_member_from_server)
+from .fragments import timezone_options
+from .onboarding import DONE, FAILED, OnboardingQueue
+from .rcos import (delete_user_discord_account, resolve_user,
+                   create_or_update_user)
+from .sessions import init_sessions
+from .validation import DEFAULT_TIMEZONE, InvalidUser, build_user
 
 # Load .env into os.environ
 load_dotenv()
 
-app = Flask(__name__)
+# Before the app is created so Flask doesn't add its own handler
+setup_logging()
+
+app = Flask(__name__, static_folder=None)
 cas = CAS(app, '/cas')
 
 csp = {
@@ -42,20 +52,43 @@ app.config['SITE_TITLE'] = os.environ.get('SITE_TITLE')
 app.config['CAS_SERVER'] = 'https://cas-auth.rpi.edu/cas'
 app.config['CAS_AFTER_LOGIN'] = 'join'
 
+# Sessions are kept server-side; the cookie only holds their id
+init_sessions(app)
+
+# Serves portal/static with hashed names; templates use asset_url()
+init_assets(app)
+
 DISCORD_SERVER_INVITE_URL = os.environ.get('DISCORD_SERVER_INVITE_URL')
 
+# Bearer token required by /internal/status, if set
+INTERNAL_STATUS_TOKEN = os.environ.get('INTERNAL_STATUS_TOKEN')
+
+# Adds users to the server in the background after the Discord callback
+onboarding_queue = OnboardingQueue()
+onboarding_queue.start()
+
 
 @app.before_request
 def before_request():
     '''Runs before every request.'''
 
-    # Try to fetch user
-    if 'user' not in session and cas.username:
-        session['user'] = fetch_user(cas.username.lower())
-    # Try to fetch user's discord account
-    if ('user_discord_account' not in session or session['user_discord_account'] is None) and cas.username:
-        session['user_discord_account'] = fetch_user_discord_account(
-            cas.username.lower())
+    g.is_degraded = False
+
+    # Try to fetch user and their discord account (cached, so not on every request)
+    if cas.username and ('user' not in session or session.get('user_discord_account') is None):
+        try:
+            # A session without an account may have just unlinked it on another worker
+            user, user_discord_account = resolve_user(cas.username.lower(), trust_cached_account='user' not in session)
+        except UpstreamUnavailable as e:
+            # Degraded mode: carry on with whatever the session already has
+            app.logger.warning('Serving session data for %s: %s', cas.username, e)
+            g.is_degraded = True
+        else:
+            if 'user' not in session:
+                session['user'] = user
+            # Only touch the session when something changed so it isn't rewritten
+            if 'user_discord_account' not in session or session['user_discord_account'] != user_discord_account:
+                session['user_discord_account'] = user_discord_account
 
     g.is_logged_in = cas.username is not None
     g.username = cas.username.lower() if g.is_logged_in else None
@@ -78,37 +111,21 @@ def join():
         if 'user_discord_account' in session and session['user_discord_account']:
             return redirect(url_for('joined'))
 
-        return render_template('join.html', is_logged_in=True, is_student=True, username=g.username, user=g.user, timezones=pytz.all_timezones)
+        return render_template('join.html', is_logged_in=True, is_student=True, username=g.username, user=g.user, timezone_options=timezone_options(g.user.timezone if g.user else None))
     elif request.method == 'POST':
-        # Limit to 20 characters so overall Discord nickname doesn't exceed limit of 32 characters
-        first_name = request.form['first_name'].strip()[:20]
-        last_name = request.form['last_name'].strip()
-
-        if len(first_name) == 0 or len(last_name) == 0:
-            flash('Nice try... Please enter a name.', category='error')
+        try:
+            user = build_user(g.username, request.form['first_name'], request.form['last_name'],
+                              request.form['timezone'] or DEFAULT_TIMEZONE, request.form.get('graduation_year'),
+                              'student')
+        except InvalidUser as e:
+            flash(f'Nice try... {e}', category='error')
             return redirect(url_for('index'))
 
-        user = {
-            'username': g.username,
-            'first_name': first_name,
-            'last_name': last_name,
-            'role': 'student',
-            'timezone': request.form['timezone']
-        }
-
-        if 'graduation_year' in request.form and len(request.form['graduation_year']):
-            graduation_year = int(request.form['graduation_year'].strip())
-            if graduation_year > 2038 or graduation_year < 2000:
-                flash(
-                    'Nice try... Stick to the allowed graduation year range.', category='error')
-                return redirect(url_for('index'))
-
-            user['cohort'] = graduation_year - 4
-
+        if 'cohort' in user:
             # This will ensure the user now exists
             session['user'] = create_or_update_user(g.username, user)
 
-        app.logger.info(f'Redirecting {g.identifier} to Discord OAuth page')
+        app.logger.info('Redirecting %s to Discord OAuth page', g.identifier)
         return redirect(OAUTH_URL)
 
 
@@ -122,14 +139,12 @@ def discord_callback():
     if error:
         # Handle the special case where the user declined to connect
         if error == 'access_denied':
-            app.logger.error(
-                f'{g.identifier} declined to connect their Discord account')
+            app.logger.error('%s declined to connect their Discord account', g.identifier)
             return render_template('error.html', error='You declined to connect your Discord account!')
         else:
             # Handle generic Discord error
             error_description = request.args.get('error_description')
-            app.logger.error(
-                f'An error occurred on the Discord callback for {g.identifier}: {error_description}')
+            app.logger.error('An error occurred on the Discord callback for %s: %s', g.identifier, error_description)
             raise Exception(error_description)
 
     # Get user from DB
@@ -137,11 +152,11 @@ def discord_callback():
 
     # Generate nickname as "<first name> <last name initial> '<2 digit graduation year>"
     # e.g. "Frank M '22"
-    nickname = user['first_name'] + ' ' + \
-        user['last_name'][0]
+    nickname = user.first_name + ' ' + \
+        user.last_name[0]
 
-    if user['cohort']:
-        nickname += " '" + str(user['cohort'] + 4)[2:]
+    if user.cohort:
+        nickname += " '" + str(user.cohort + 4)[2:]
 
     # Exchange authorization code for tokens
     tokens = get_tokens(authorization_code)
@@ -149,43 +164,45 @@ def discord_callback():
     # Get info on the Discord user that just connected (really only need id)
     discord_user = get_user_info(tokens['access_token'])
 
-    # Save to DB
-    create_or_update_user_discord_account(user['username'], discord_user['id'])
+    # Save to DB and add them to the server in the background; /joined shows the progress
+    session['onboarding_job'] = onboarding_queue.enqueue(
+        user.username, discord_user['id'], nickname, tokens['access_token'])
+    app.logger.info('Queued adding %s to Discord server', g.identifier)
 
-    # Add them to the server
-    add_user_to_server(tokens['access_token'],
-                       discord_user['id'], nickname)
-    app.logger.info(f'Added {g.identifier} to Discord server')
+    return redirect(url_for('joined'))
 
-    # Set their nickname
-    try:
-        set_member_nickname(discord_user['id'], nickname)
-        app.logger.info(
-            f'Set {g.username}\'s nickname to "{nickname}" on server')
-    except requests.exceptions.HTTPError as e:
-        app.logger.warning(
-            f'Failed to set nickname "{nickname}" to {g.username} on server: {e}')
-
-    # Give them the verified role
-    try:
-        add_role_to_member(discord_user['id'], VERIFIED_ROLE_ID)
-        app.logger.info(f'Added verified role to {g.username} on server')
-    except requests.exceptions.HTTPError as e:
-        app.logger.warning(
-            f'Failed to add role to {g.username} on server: {e}')
 
-    return redirect(url_for('joined'))
+def current_onboarding_job():
+    '''The user's onboarding job from this session, if it is still known.'''
+    job_id = session.get('onboarding_job')
+    if job_id is None:
+        return None
+    job = onboarding_queue.get(job_id)
+    if job is None or job['username'] != g.username:
+        session.pop('onboarding_job')
+        return None
+    return job
+
+
+@app.route('/onboarding/status')
+@login_required
+def onboarding_status():
+    '''Polled by the page shown while the user is being added to the server.'''
+    job = current_onboarding_job()
+    if job is None:
+        abort(404)
+    return jsonify(status=job['status'], attempts=job['attempts'])
 
 
 @app.route('/discord/reset')
 @login_required
 def reset_discord():
-    discord_user_id = session['user_discord_account']['account_id']
+    discord_user_id = session['user_discord_account'].account_id
 
     # Attempt to kick member from server and then remove DB records
     try:
         kick_member_from_server(discord_user_id)
-        delete_user_discord_account(session['user']['username'])
+        delete_user_discord_account(session['user'].username)
         session['user_discord_account'] = None
     except:
         raise Exception('Failed to kick your old account from the server.')
@@ -196,15 +213,34 @@ def reset_discord():
 @app.route('/joined')
 @login_required
 def joined():
+    job = current_onboarding_job()
+    if job is not None:
+        if job['status'] == FAILED:
+            session.pop('onboarding_job')
+            app.logger.error('Failed to add %s to Discord server: %s', g.identifier, job['error'])
+            return render_template('error.html', error='We could not add you to the Discord server. Please try connecting again.')
+        if job['status'] != DONE:
+            return render_template('onboarding.html')
+
+        session.pop('onboarding_job')
+        session['user_discord_account'] = UserAccount(username=job['username'], type='discord',
+                                                      account_id=job['discord_user_id'])
+        app.logger.info('Added %s to Discord server', g.identifier)
+
     # Hasn't connected yet, redirect to form
-    if session['user_discord_account'] is None:
+    if session.get('user_discord_account') is None:
         return redirect('/')
     try:
-        discord_member = get_member(session['user_discord_account']['account_id'])
+        discord_member = get_member(session['user_discord_account'].account_id)
+    except UpstreamUnavailable as e:
+        # Degraded mode: show the page without their live member details
+        app.logger.warning('Showing %s without their member details: %s', g.identifier, e)
+        g.is_degraded = True
+        discord_member = None
     except HTTPError as err:
         if err.response.status_code == 404:
             # User disconnected Discord through a different means than this website... REMOVE THEIR RECORD
-            delete_user_discord_account(session['user']['username'])
+            delete_user_discord_account(session['user'].username)
             session['user_discord_account'] = None
             return redirect(url_for('join'))
         raise err
@@ -212,6 +248,36 @@ def joined():
     return render_template('joined.html', rcs_id=cas.username.lower(), user=session['user'], discord_member=discord_member, discord_server_id=SERVER_ID)
 
 
+def require_internal_token():
+    '''Hide internal endpoints from requests without the INTERNAL_STATUS_TOKEN bearer token, if one is set.'''
+    if INTERNAL_STATUS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                         'Bearer ' + INTERNAL_STATUS_TOKEN):
+        abort(404)
+
+
+@app.route('/metrics')
+def metrics():
+    '''Outbound call metrics of this worker in the Prometheus text format.'''
+    require_internal_token()
+    return metrics_registry.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
+
+@app.route('/internal/status')
+def internal_status():
+    '''Circuit breaker states of this worker.'''
+    require_internal_token()
+    return jsonify(pid=os.getpid(), breakers=breaker_statuses())
+
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(e):
+    '''Fail fast while Discord or the RCOS API is struggling instead of waiting on it.'''
+    app.logger.warning('Failing fast for %s: %s', g.get('identifier', 'a user'), e)
+    return render_template('error.html', error='This site is having trouble reaching Discord or the RCOS database. Please try again in a minute.'), 503, {
+        'Retry-After': str(max(int(e.retry_after), 1))
+    }
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     '''Render 404 page.'''
@@ -0,0 +1,217 @@
+'''A durable queue of onboarding jobs run by a pool of background workers.
+
+The Discord callback only exchanges the authorization code and looks up who the user
+is, then queues a job that saves their account link and adds them to the server
+with their nickname and role. Jobs are stored in SQLite so they survive a worker
+restart, are retried with backoff when an upstream fails temporarily, and can be
+claimed by any process sharing the file. A job's access token is erased as soon
+as it is finished.
+'''
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+import requests
+from dotenv import load_dotenv
+
+from common.breaker import UpstreamUnavailable
+
+from .discord import onboard_member
+from .rcos import create_or_update_user_discord_account
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+QUEUE_PATH = os.environ.get('ONBOARDING_QUEUE_PATH', 'onboarding.sqlite3')
+
+# Number of jobs each process runs at once
+WORKERS = int(os.environ.get('ONBOARDING_WORKERS', 4))
+
+# Attempts before a job is given up on
+MAX_ATTEMPTS = int(os.environ.get('ONBOARDING_MAX_ATTEMPTS', 5))
+
+# Seconds before a job left running (e.g. by a killed process) is picked up again
+LEASE = 120
+
+# Seconds finished jobs are kept around so their status can still be shown
+RETENTION = 24 * 60 * 60
+
+# Seconds an idle worker waits before checking for jobs queued by another process
+POLL_INTERVAL = 1.0
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def is_temporary(err: Exception) -> bool:
+    '''Whether an error is worth retrying: network errors, 429s, server errors and open breakers.'''
+    if isinstance(err, UpstreamUnavailable):
+        return True
+    if isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+        return err.response.status_code == 429 or err.response.status_code >= 500
+    return False
+
+
+def backoff(attempts: int) -> float:
+    return min(2 ** attempts, 60)
+
+
+def run_job(job: Dict):
+    '''Save the user's Discord account and make sure they are on the server.'''
+    # HTTPErrors go to is_temporary, so e.g. a 409 for an account linked to someone else fails at once
+    create_or_update_user_discord_account(job['username'], job['discord_user_id'])
+
+    try:
+        changes = onboard_member(job['access_token'], job['discord_user_id'], job['nickname'])
+        if changes:
+            logger.info('Updated %s of %s on server', ', '.join(changes), job['username'])
+    except requests.exceptions.HTTPError as err:
+        # Only failing to update an existing member is recoverable
+        if err.request is None or err.request.method != 'PATCH' or is_temporary(err):
+            raise err
+        logger.warning('Failed to set nickname "%s" and role of %s on server: %s', job['nickname'], job['username'], err)
+
+
+class OnboardingQueue:
+    def __init__(self, path: str = QUEUE_PATH):
+        self.path = path
+        # Wakes idle workers when a job is queued by this process
+        self.wakeup = threading.Event()
+        self.threads = []
+        with self.connect() as connection:
+            # WAL lets status reads and idle workers' checks go ahead while a job is claimed
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS onboarding_jobs (
+                    id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    discord_user_id TEXT NOT NULL,
+                    nickname TEXT NOT NULL,
+                    access_token TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    run_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS onboarding_jobs_status ON onboarding_jobs (status, run_at)')
+        self.prune()
+
+    def connect(self) -> sqlite3.Connection:
+        # A connection per use, since jobs are queued and run from many threads
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def enqueue(self, username: str, discord_user_id: str, nickname: str, access_token: str) -> str:
+        '''Queue a job and return its id.'''
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT INTO onboarding_jobs (id, username, discord_user_id, nickname, access_token, status, run_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, username, discord_user_id, nickname, access_token, QUEUED, now, now))
+        self.wakeup.set()
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        '''Get a job's public fields (everything but the access token), or None.'''
+        with self.connect() as connection:
+            row = connection.execute(
+                'SELECT id, username, discord_user_id, status, attempts, error FROM onboarding_jobs WHERE id = ?',
+                (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self) -> Optional[Dict]:
+        '''Take the next due job, or one whose worker died, and mark it running.'''
+        now = time.time()
+        due_query = ('SELECT * FROM onboarding_jobs WHERE (status = ? AND run_at <= ?) OR (status = ? AND updated_at < ?) '
+                     'ORDER BY run_at LIMIT 1')
+        due_params = (QUEUED, now, RUNNING, now - LEASE)
+        connection = self.connect()
+        connection.isolation_level = None
+        try:
+            # Only take the write lock when there is something to claim, so idle
+            # workers don't contend for it every POLL_INTERVAL
+            if connection.execute(due_query, due_params).fetchone() is None:
+                return None
+            # IMMEDIATE takes the write lock up front so two workers can't claim the same job
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute(due_query, due_params).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE onboarding_jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                    (RUNNING, now, row['id']))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return {**dict(row), 'status': RUNNING, 'attempts': row['attempts'] + 1}
+
+    def retry(self, job: Dict, error: str):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                'UPDATE onboarding_jobs SET status = ?, error = ?, run_at = ?, updated_at = ? WHERE id = ?',
+                (QUEUED, error, now + backoff(job['attempts']), now, job['id']))
+
+    def finish(self, job: Dict, status: str, error: Optional[str] = None):
+        '''Mark a job done or failed and erase its access token.'''
+        with self.connect() as connection:
+            connection.execute(
+                'UPDATE onboarding_jobs SET status = ?, error = ?, access_token = NULL, updated_at = ? WHERE id = ?',
+                (status, error, time.time(), job['id']))
+
+    def prune(self):
+        '''Forget jobs that finished long enough ago.'''
+        with self.connect() as connection:
+            connection.execute('DELETE FROM onboarding_jobs WHERE status IN (?, ?) AND updated_at < ?',
+                               (DONE, FAILED, time.time() - RETENTION))
+
+    def process(self, job: Dict):
+        try:
+            run_job(job)
+        except Exception as err:
+            if is_temporary(err) and job['attempts'] < MAX_ATTEMPTS:
+                logger.warning('Onboarding %s failed (attempt %d), retrying: %s', job['username'], job['attempts'], err)
+                self.retry(job, str(err))
+            else:
+                logger.error('Onboarding %s failed: %s', job['username'], err)
+                self.finish(job, FAILED, str(err))
+            return
+        logger.info('Onboarded %s as Discord user %s', job['username'], job['discord_user_id'])
+        self.finish(job, DONE)
+
+    def work(self):
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.Error as err:
+                logger.error('Failed to claim an onboarding job: %s', err)
+                job = None
+            if job is None:
+                self.wakeup.wait(POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            self.process(job)
+
+    def start(self, workers: int = WORKERS):
+        '''Start the worker threads (greenlets under gevent) for this process.'''
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
@@ -1,101 +1,129 @@
-from typing import Dict, Optional
-import requests
+import logging
 import os
-import jwt
+from typing import Dict, Optional, Tuple
 
 from requests.exceptions import HTTPError
 
-API_URL = os.environ.get('RCOS_API_URL')
-JWT_SECRET = os.environ["POSTGREST_JWT_SECRET"]
+from api import client
+from api.models import User, UserAccount
+from common.cache import TTLCache
 
+logger = logging.getLogger(__name__)
 
-# Create JSON Web Token to authenticate Postgrest
-encoded_jwt = jwt.encode({"role": "api_user"}, JWT_SECRET,
-                         algorithm="HS256")
+# Users and their Discord accounts by username. Users that haven't linked an
+# account yet are only remembered briefly since they are likely about to.
+# Each worker has its own cache and only invalidates its own entries, so after an
+# account is unlinked another worker can still have it cached for USER_CACHE_TTL;
+# before_request doesn't trust cached accounts for sessions without one for that reason.
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get('USER_CACHE_NEGATIVE_TTL', 30))
+user_cache = TTLCache(USER_CACHE_TTL, USER_CACHE_NEGATIVE_TTL)
 
 
-api = requests.Session()
-api.headers['Authorization'] = 'Bearer ' + encoded_jwt
+def create_or_update_user(username: str, user: Dict) -> Optional[User]:
+    try:
+        return client.put('/users', params={
+            'username': 'eq.' + username
+        }, json=user, headers={
+            'Prefer': 'return=representation'
+        }, model=User)[0]
+    except HTTPError as err:
+        logger.error('%s: %s', err, err.response.text)
+        return None
+    finally:
+        user_cache.invalidate(username)
 
 
-def create_or_update_user(username: str, user: Dict) -> Optional[Dict]:
-    r = api.put(f'{API_URL}/users', params={
-        'username': 'eq.' + username
-    }, json=user, headers={
-        'Prefer': 'return=representation'
-    })
+def fetch_user(username: str) -> Optional[User]:
     try:
-        r.raise_for_status()
+        return client.get('/users', params={
+            'username': 'eq.' + username
+        }, single=True, model=User)
     except HTTPError as err:
-        print(err)
-        print(err.response.json())
+        logger.error('%s: %s', err, err.response.text)
         return None
-    return r.json()[0]
 
 
-def fetch_user(username: str) -> Optional[Dict]:
-    r = api.get(API_URL + '/users', params={
-        'username': 'eq.' + username
-    }, headers={
-        'Accept': 'application/vnd.pgrst.object+json'
-    })
+def fetch_user_discord_account(username: str) -> Optional[UserAccount]:
     try:
-        r.raise_for_status()
+        return client.get('/user_accounts', params={
+            'username': 'eq.' + username,
+            'type': 'eq.discord'
+        }, single=True, model=UserAccount)
     except HTTPError as err:
-        print(err)
-        print(err.response.json())
+        logger.error('%s: %s', err, err.response.text)
         return None
-    return r.json()
 
 
-def fetch_user_discord_account(username: str) -> Optional[Dict]:
-    r = api.get(f'{API_URL}/user_accounts', params={
-        'username': 'eq.' + username,
-        'type': 'eq.discord'
-    }, headers={
-        'Authentication': 'Bearer ' + encoded_jwt,
-        'Accept': 'application/vnd.pgrst.object+json'
-    })
+def fetch_user_and_discord_account(username: str) -> Optional[Tuple[Optional[User], Optional[UserAccount]]]:
+    '''
+    Fetch a user and their Discord account (if any) in a single query by embedding
+    user_accounts in the users select. Returns None if the request failed.
+    '''
     try:
-        r.raise_for_status()
+        users = client.get('/users', params={
+            'username': 'eq.' + username,
+            'select': '*,user_accounts(*)',
+            'user_accounts.type': 'eq.discord'
+        })
     except HTTPError as err:
-        print(err)
-        print(err.response.json())
+        logger.error('%s: %s', err, err.response.text)
         return None
-    return r.json()
-
-
-def create_or_update_user_discord_account(username: str, discord_user_id: str):
-    r = api.put(f'{API_URL}/user_accounts', params={
-        'username': 'eq.' + username,
-        'type': 'eq.discord'
-    }, json={
-        'username': username,
-        'type': 'discord',
-        'account_id': discord_user_id
-    }, headers={
-        'Prefer': 'return=representation'
-    })
+    if len(users) == 0:
+        return None, None
+    accounts = users[0]['user_accounts']
+    return User.from_row(users[0]), (UserAccount.from_row(accounts[0]) if len(accounts) else None)
+
+
+def resolve_user(username: str, trust_cached_account: bool = True) -> Tuple[Optional[User], Optional[UserAccount]]:
+    '''
+    Get a user and their Discord account through the cache, including the fact
+    that they don't exist or haven't linked an account yet. With
+    trust_cached_account=False a cached Discord account is fetched again, since
+    another worker may have unlinked it.
+    '''
+    hit, result = user_cache.get(username)
+    if hit and (trust_cached_account or result[1] is None):
+        return result
+
+    result = fetch_user_and_discord_account(username)
+    if result is None:
+        # Don't remember failed requests
+        return None, None
+    user_cache.set(username, result, is_negative=result[1] is None)
+    return result
+
+
+def create_or_update_user_discord_account(username: str, discord_user_id: str) -> UserAccount:
+    '''Link a Discord account to a user. Raises HTTPError on failure so callers can tell 4xx from 5xx.'''
     try:
-        r.raise_for_status()
+        return client.put('/user_accounts', params={
+            'username': 'eq.' + username,
+            'type': 'eq.discord'
+        }, json={
+            'username': username,
+            'type': 'discord',
+            'account_id': discord_user_id
+        }, headers={
+            'Prefer': 'return=representation'
+        }, model=UserAccount)[0]
     except HTTPError as err:
-        print(err)
-        print(err.response.json())
-        return None
-    return r.json()
+        logger.error('%s: %s', err, err.response.text)
+        raise
+    finally:
+        user_cache.invalidate(username)
 
 
 def delete_user_discord_account(username: str):
-    r = api.delete(f'{API_URL}/user_accounts', params={
-        'username': 'eq.' + username,
-        'type': 'eq.discord'
-    }, headers={
-        'Prefer': 'return=representation'
-    })
     try:
-        r.raise_for_status()
+        return client.delete('/user_accounts', params={
+            'username': 'eq.' + username,
+            'type': 'eq.discord'
+        }, headers={
+            'Prefer': 'return=representation'
+        })
     except HTTPError as err:
-        print(err)
-        print(err.response.json())
+        logger.error('%s: %s', err, err.response.text)
         return None
-    return r.json()
+    finally:
+        user_cache.invalidate(username)
@@ -0,0 +1,185 @@
+'''Server-side sessions stored in SQLite, with only a random id kept in the cookie.
+
+The cookie no longer carries the user's records, so it stays small and isn't resent
+whenever they change. All gunicorn workers on a host share the same database file.
+Sessions expire after the app's PERMANENT_SESSION_LIFETIME without being used, and
+expired rows are deleted by a background thread. The time spent loading and storing
+sessions is recorded in the metrics registry.
+
+Records from api.models (the user and their Discord account) are stored as their
+packed list of values tagged with the record type, rather than as full objects.
+Sessions whose records no longer unpack (after a record type changed) are dropped.
+'''
+
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from flask import Flask, Request, Response
+from flask.json.tag import JSONTag
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+
+from api.models import RECORD_TYPES, Record, RecordError
+from common.metrics import registry
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH = os.environ.get('SESSION_STORE_PATH', 'sessions.sqlite3')
+
+# Seconds between deleting expired sessions
+EVICT_INTERVAL = int(os.environ.get('SESSION_EVICT_INTERVAL', 300))
+
+session_operation_duration = registry.histogram(
+    'session_operation_duration_seconds', 'Time spent loading and storing server-side sessions',
+    ['operation'])
+
+
+class TagRecord(JSONTag):
+    __slots__ = ()
+    key = ' r'
+
+    def check(self, value) -> bool:
+        return isinstance(value, Record)
+
+    def to_json(self, value: Record):
+        return [type(value).__name__, value.pack()]
+
+    def to_python(self, value) -> Record:
+        if value[0] not in RECORD_TYPES:
+            raise RecordError(f'Unknown record type {value[0]}')
+        return RECORD_TYPES[value[0]].unpack(value[1])
+
+
+session_json_serializer.register(TagRecord)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial: Optional[Dict] = None, sid: Optional[str] = None, expires_at: Optional[float] = None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+
+
+class SessionStore:
+    def __init__(self, path: str = STORE_PATH):
+        self.path = path
+        with self.connect() as connection:
+            # WAL lets workers read while another one writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self, sid: str) -> Optional[Tuple[bytes, float]]:
+        '''Get a session's data and expiry time if it exists and hasn't expired.'''
+        with self.connect() as connection:
+            return connection.execute('SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?',
+                                      (sid, time.time())).fetchone()
+
+    def save(self, sid: str, data: bytes, expires_at: float):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (sid, data, expires_at))
+
+    def delete(self, sid: str):
+        with self.connect() as connection:
+            connection.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+
+    def evict(self) -> int:
+        '''Delete expired sessions. Returns how many were deleted.'''
+        with self.connect() as connection:
+            return connection.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),)).rowcount
+
+
+class SqliteSessionInterface(SessionInterface):
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    def open_session(self, app: Flask, request: Request) -> ServerSession:
+        sid = request.cookies.get(app.session_cookie_name)
+        if not sid:
+            return ServerSession()
+
+        started = time.perf_counter()
+        row = self.store.load(sid)
+        session_operation_duration.observe(time.perf_counter() - started, 'load')
+        if row is None:
+            # Expired or unknown ids are never reused
+            return ServerSession()
+        data, expires_at = row
+        try:
+            return ServerSession(session_json_serializer.loads(data), sid, expires_at)
+        except RecordError as err:
+            # Stored before a record type changed; the user's records are loaded again
+            logger.info('Dropping session with outdated records: %s', err)
+            self.store.delete(sid)
+            return ServerSession()
+
+    def save_session(self, app: Flask, session: ServerSession, response: Response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        is_new = session.sid is None
+        # Unchanged sessions are only rewritten to push back their expiry, at most
+        # once per half lifetime, so most requests only read
+        if not is_new and not session.modified and session.expires_at - now > lifetime / 2:
+            return
+
+        if is_new:
+            session.sid = secrets.token_urlsafe(24)
+        session.expires_at = now + lifetime
+        started = time.perf_counter()
+        self.store.save(session.sid, session_json_serializer.dumps(dict(session)), session.expires_at)
+        session_operation_duration.observe(time.perf_counter() - started, 'store')
+
+        if is_new or session.permanent:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def evict_periodically(store: SessionStore, interval: int = EVICT_INTERVAL):
+    while True:
+        time.sleep(interval)
+        try:
+            evicted = store.evict()
+        except sqlite3.Error as err:
+            logger.error('Failed to evict expired sessions: %s', err)
+            continue
+        if evicted:
+            logger.info('Evicted %d expired sessions', evicted)
+
+
+def init_sessions(app: Flask, path: str = STORE_PATH) -> SessionStore:
+    '''Store the app's sessions server-side and start evicting expired ones in the background.'''
+    store = SessionStore(path)
+    app.session_interface = SqliteSessionInterface(store)
+    threading.Thread(target=evict_periodically, args=(store,), daemon=True).start()
+    return store
@@ -0,0 +1,14 @@
+// Reload once the onboarding job has finished (either way) so the result is shown
+function checkOnboarding() {
+    fetch('/onboarding/status', { credentials: 'same-origin' })
+        .then(function (response) { return response.ok ? response.json() : { status: 'done' } })
+        .then(function (job) {
+            if (job.status === 'done' || job.status === 'failed') {
+                window.location.reload()
+            } else {
+                setTimeout(checkOnboarding, 1000)
+            }
+        })
+        .catch(function () { setTimeout(checkOnboarding, 3000) })
+}
+setTimeout(checkOnboarding, 500)
@@ -0,0 +1,61 @@
+'''Validation of user details, shared by the join form and bulk provisioning.'''
+
+from typing import Dict, Optional
+
+# Limit to 20 characters so overall Discord nickname doesn't exceed limit of 32 characters
+MAX_FIRST_NAME_LENGTH = 20
+
+MIN_GRADUATION_YEAR = 2000
+MAX_GRADUATION_YEAR = 2038
+
+DEFAULT_TIMEZONE = 'America/New_York'
+
+# Values of the users.role enum
+ROLES = ('student', 'faculty', 'faculty_advisor', 'alumn', 'external', 'external_mentor')
+
+
+class InvalidUser(ValueError):
+    '''Raised with a message for the user when their details are not acceptable.'''
+
+
+def build_user(username: str, first_name: str, last_name: str, timezone: Optional[str] = None,
+               graduation_year: Optional[str] = None, role: Optional[str] = None) -> Dict:
+    '''
+    Clean up and check a user's details and build the users row for them.
+    The timezone, cohort and role are only set when given, so upserting the row
+    keeps a user's existing values for them.
+    '''
+    username = username.strip().lower()
+    first_name = first_name.strip()[:MAX_FIRST_NAME_LENGTH]
+    last_name = last_name.strip()
+
+    if len(username) == 0:
+        raise InvalidUser('Please enter an RCS ID.')
+    if len(first_name) == 0 or len(last_name) == 0:
+        raise InvalidUser('Please enter a name.')
+
+    user = {
+        'username': username,
+        'first_name': first_name,
+        'last_name': last_name
+    }
+
+    if timezone:
+        user['timezone'] = timezone
+
+    if role:
+        role = role.strip().lower()
+        if role not in ROLES:
+            raise InvalidUser(f'Role must be one of {", ".join(ROLES)}.')
+        user['role'] = role
+
+    if graduation_year is not None and len(str(graduation_year).strip()):
+        try:
+            graduation_year = int(str(graduation_year).strip())
+        except ValueError:
+            raise InvalidUser('Please enter a graduation year as a number.')
+        if graduation_year > MAX_GRADUATION_YEAR or graduation_year < MIN_GRADUATION_YEAR:
+            raise InvalidUser('Stick to the allowed graduation year range.')
+        user['cohort'] = graduation_year - 4
+
+    return user
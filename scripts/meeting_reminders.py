@@ -1,14 +1,24 @@
-import requests
-from requests import HTTPError
+from requests import HTTPError, RequestException
+import argparse
 import datetime
-from dateutil.relativedelta import relativedelta
+import heapq
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 import os
 
-from api import API_URL, encoded_jwt
+from api import client
+from api.models import Meeting, UserAccount
+from common.breaker import UpstreamUnavailable
+from common.logs import setup_logging
+from scripts.reminder_ledger import ReminderLedger
+from scripts.webhooks import WEBHOOK_BATCH_WINDOW, WebhookQueue
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 webhook_url = os.environ['MEETING_WEBHOOK_URL']
 
 meeting_type_colors = {
@@ -19,91 +29,245 @@ meeting_type_colors = {
 
 default_meeting_color = None
 
-def fetch_upcoming_meetings():
-    format = '%Y-%m-%dT%H:%M:%S'
+format = '%Y-%m-%dT%H:%M:%S'
+
+# Daemon mode: how long before a meeting its reminder is sent, how often meeting
+# changes are pulled, and how often the whole cache is reloaded to notice deletions
+REMINDER_LEAD_TIME = datetime.timedelta(minutes=int(os.environ.get('REMINDER_LEAD_MINUTES', 15)))
+REFRESH_INTERVAL = int(os.environ.get('REMINDER_REFRESH_SECONDS', 120))
+FULL_RESYNC_INTERVAL = int(os.environ.get('REMINDER_FULL_RESYNC_SECONDS', 3600))
+
+# Seconds between pruning old entries from the ledger while running as a daemon
+LEDGER_PRUNE_INTERVAL = 24 * 60 * 60
+
+
+def fetch_upcoming_meetings() -> List[Meeting]:
+    '''Fetch the public meetings starting in the next 2 hours.'''
     start = datetime.datetime.now().strftime(format)
     end = (datetime.datetime.now() + datetime.timedelta(hours=2)).strftime(format)
-    r = requests.get(f'{API_URL}/public_meetings', params=[
+    upcoming_meetings = client.get('/public_meetings', params=[
         ('start_date_time', 'gte.' + start),
         ('start_date_time', 'lte.' + end)
-    ])
-    r.raise_for_status()
-    upcoming_meetings = r.json()
+    ], model=Meeting)
 
+    public_meetings = []
     for meeting in upcoming_meetings:
-        if not meeting['is_public']:
-            print(f'Skipping non-public meeting {meeting["meeting_id"]}: {meeting["title"]}')
+        if not meeting.is_public:
+            logger.info('Skipping non-public meeting %s: %s', meeting.meeting_id, meeting.title)
             continue
+        public_meetings.append(meeting)
+    return public_meetings
 
-        meeting_start_date_time = datetime.datetime.strptime(meeting['start_date_time'], format)
-        meeting_end_date_time = datetime.datetime.strptime(meeting['end_date_time'], format)
-
-        meeting_type_display = ' '.join(map(str.capitalize, meeting['type'].split('_'))) + ' Meeting'
-        date_str = datetime.datetime.strftime(meeting_start_date_time, '%A, %b %-d, %Y')
-
-        color = meeting_type_colors[meeting['type']] if meeting['type'] in meeting_type_colors else default_meeting_color
-
-        time_until = relativedelta(meeting_start_date_time, datetime.datetime.now())
-
-        fields = [
-            {
-                'name': 'Start',
-                'value': datetime.datetime.strftime(meeting_start_date_time, '%-I:%M %p'),
-                'inline': True
-            },
-            {
-                'name': 'End',
-                'value': datetime.datetime.strftime(meeting_end_date_time, '%-I:%M %p'),
-                'inline': True
-            },
-            {
-                'name': 'Location',
-                'value': meeting['location'] or 'Not given',
-                'inline': True
-            },
-            {
-                'name': 'Agenda',
-                'value': '\n'.join(map(lambda s: '- '+s, meeting['agenda'])) if len(meeting['agenda']) else 'Not given',
-                'inline': True
-            }
-        ]
-
-        if meeting['host_username']:
-            # Fetch host Discord account
-            hr = requests.get(f'{API_URL}/user_accounts', params={
-                'username': 'eq.' + meeting['host_username'],
-                'type': 'eq.discord'
-            }, headers={
-                'Authorization': 'Bearer ' + encoded_jwt,
-                'Accept': 'application/vnd.pgrst.object+json'
-            })
-            try:
-                hr.raise_for_status()
-
-                host_discord_user_id = hr.json()['account_id']
-                fields.append({
-                    'name': 'Hosted By',
-                    'value': f'<@{host_discord_user_id}>',
-                    'inline': True
-                })
-            except HTTPError as err:
-                print(err.response.json())
-                print(f'Failed to fetch host Discord account for {meeting["host_username"]}')
-
-        w = requests.post(webhook_url, json={
-            'embeds': [{
-                'title': meeting['title'] or 'Untitled Meeting',
-                'description': f'{meeting_type_display} starting in **{time_until.minutes} minutes**!',
-                'fields': fields,
-                'color': color,
-                'url': f'https://rcos-meetings.herokuapp.com/meetings/{meeting["meeting_id"]}'
-            }]
+
+def fetch_host_discord_accounts(meetings: List[Meeting]) -> Dict[str, str]:
+    '''Get the Discord user ids of all of the meetings' hosts (by username) in one query.'''
+    host_usernames = [meeting.host_username for meeting in meetings if meeting.host_username]
+    if len(host_usernames) == 0:
+        return {}
+
+    try:
+        accounts = client.get_many('/user_accounts', 'username', host_usernames, params={
+            'type': 'eq.discord'
+        }, model=UserAccount)
+    except HTTPError as err:
+        logger.error('Failed to fetch host Discord accounts for %s: %s', ', '.join(host_usernames), err.response.text)
+        return {}
+
+    for username in set(host_usernames) - accounts.keys():
+        logger.info('No host Discord account for %s', username)
+    return {username: account.account_id for username, account in accounts.items()}
+
+
+def meeting_type_display(meeting: Meeting) -> str:
+    return ' '.join(map(str.capitalize, meeting.type.split('_'))) + ' Meeting'
+
+
+def build_embed(meeting: Meeting, host_discord_user_id: Optional[str], now: datetime.datetime) -> Dict:
+    '''Build the reminder embed for a meeting. Makes no requests.'''
+    meeting_start_date_time = datetime.datetime.strptime(meeting.start_date_time, format)
+    meeting_end_date_time = datetime.datetime.strptime(meeting.end_date_time, format)
+
+    color = meeting_type_colors[meeting.type] if meeting.type in meeting_type_colors else default_meeting_color
+
+    minutes_until = max(round((meeting_start_date_time - now).total_seconds() / 60), 0)
+
+    fields = [
+        {
+            'name': 'Start',
+            'value': datetime.datetime.strftime(meeting_start_date_time, '%-I:%M %p'),
+            'inline': True
+        },
+        {
+            'name': 'End',
+            'value': datetime.datetime.strftime(meeting_end_date_time, '%-I:%M %p'),
+            'inline': True
+        },
+        {
+            'name': 'Location',
+            'value': meeting.location or 'Not given',
+            'inline': True
+        },
+        {
+            'name': 'Agenda',
+            'value': '\n'.join(map(lambda s: '- '+s, meeting.agenda)) if meeting.agenda else 'Not given',
+            'inline': True
+        }
+    ]
+
+    if host_discord_user_id:
+        fields.append({
+            'name': 'Hosted By',
+            'value': f'<@{host_discord_user_id}>',
+            'inline': True
         })
 
-        print(f'{w.status_code} - Sent webhook reminder about {meeting["meeting_id"]} {meeting_type_display}: {meeting["title"]}')
+    return {
+        'title': meeting.title or 'Untitled Meeting',
+        'description': f'{meeting_type_display(meeting)} starting in **{minutes_until} minutes**!',
+        'fields': fields,
+        'color': color,
+        'url': f'https://rcos-meetings.herokuapp.com/meetings/{meeting.meeting_id}'
+    }
+
+
+def send_reminders(meetings: List[Meeting], ledger: ReminderLedger, queue: WebhookQueue):
+    '''Send reminders for the given meetings, skipping those already reminded about.'''
+    meetings = ledger.unsent(meetings)
+    host_discord_accounts = fetch_host_discord_accounts(meetings)
+
+    now = datetime.datetime.now()
+    futures = [queue.put(webhook_url, build_embed(meeting, host_discord_accounts.get(meeting.host_username), now))
+               for meeting in meetings]
+    report = queue.flush(webhook_url)
+
+    sent = []
+    for meeting, future in zip(meetings, futures):
+        try:
+            future.result()
+        except Exception as err:
+            logger.error('Failed to send webhook reminder about %s %s: %s', meeting.meeting_id, meeting_type_display(meeting), err)
+            continue
+        sent.append(meeting)
+        logger.info('Sent webhook reminder about %s %s: %s', meeting.meeting_id, meeting_type_display(meeting), meeting.title)
+    ledger.mark_sent(sent)
+    logger.info('Reminders: %s', report)
+
+
+class MeetingCache:
+    '''
+    Local copy of all upcoming public meetings. After the first load, only meetings
+    updated since the last sync are pulled.
+    '''
+
+    def __init__(self):
+        self.meetings: Dict[int, Meeting] = {}
+        # Latest updated_at seen, using the database's clock rather than ours
+        self.last_updated_at: Optional[str] = None
+        self.last_full_sync = 0.0
+
+    def refresh(self) -> List[Meeting]:
+        '''Pull new and changed meetings. Returns the upcoming public meetings that changed.'''
+        now = datetime.datetime.now().strftime(format)
+        is_full_sync = self.last_updated_at is None or time.monotonic() - self.last_full_sync > FULL_RESYNC_INTERVAL
+
+        if is_full_sync:
+            rows = client.get('/public_meetings', params={
+                'start_date_time': 'gte.' + now
+            }, model=Meeting)
+            self.meetings = {}
+            self.last_full_sync = time.monotonic()
+        else:
+            rows = client.get('/public_meetings', params={
+                'updated_at': 'gt.' + self.last_updated_at
+            }, model=Meeting)
+
+        changed = []
+        for meeting in rows:
+            if self.last_updated_at is None or meeting.updated_at > self.last_updated_at:
+                self.last_updated_at = meeting.updated_at
+            if meeting.start_date_time < now or not meeting.is_public:
+                self.meetings.pop(meeting.meeting_id, None)
+                continue
+            self.meetings[meeting.meeting_id] = meeting
+            changed.append(meeting)
+
+        # Forget meetings that have started
+        for meeting_id in [meeting_id for meeting_id, meeting in self.meetings.items() if meeting.start_date_time < now]:
+            del self.meetings[meeting_id]
+        return changed
+
+
+def reminder_time(meeting: Meeting) -> datetime.datetime:
+    return datetime.datetime.strptime(meeting.start_date_time, format) - REMINDER_LEAD_TIME
+
 
-try:
-    fetch_upcoming_meetings()
-except HTTPError as e:
-    print(e)
-    print(e.response.json())
\ No newline at end of file
+def run_daemon(ledger: ReminderLedger, queue: WebhookQueue):
+    '''
+    Keep the meeting cache fresh and send each reminder exactly REMINDER_LEAD_TIME
+    before its meeting starts, using a heap of timers ordered by reminder time.
+    '''
+    cache = MeetingCache()
+    # (reminder time, meeting id, start time) entries. Entries for meetings that were
+    # since rescheduled or removed are left in place and skipped when they come up.
+    timers: List[Tuple[datetime.datetime, int, str]] = []
+    next_refresh = 0.0
+    # Opening the ledger pruned it
+    next_prune = time.monotonic() + LEDGER_PRUNE_INTERVAL
+
+    while True:
+        if time.monotonic() >= next_prune:
+            ledger.prune()
+            next_prune = time.monotonic() + LEDGER_PRUNE_INTERVAL
+
+        if time.monotonic() >= next_refresh:
+            try:
+                for meeting in cache.refresh():
+                    heapq.heappush(timers, (reminder_time(meeting), meeting.meeting_id, meeting.start_date_time))
+            except HTTPError as e:
+                logger.error('%s: %s', e, e.response.text)
+            except (RequestException, UpstreamUnavailable) as e:
+                logger.error('Failed to refresh meetings: %s', e)
+            next_refresh = time.monotonic() + REFRESH_INTERVAL
+
+        # A meeting updated several times has several timers, so collect by id.
+        # Reminders due within the batch window are sent early so they share messages.
+        due = {}
+        now = datetime.datetime.now()
+        if len(timers) and timers[0][0] <= now:
+            batch_until = now + datetime.timedelta(seconds=WEBHOOK_BATCH_WINDOW)
+            while len(timers) and timers[0][0] <= batch_until:
+                _, meeting_id, start_date_time = heapq.heappop(timers)
+                meeting = cache.meetings.get(meeting_id)
+                if meeting is not None and meeting.start_date_time == start_date_time:
+                    due[meeting_id] = meeting
+        if len(due):
+            try:
+                send_reminders(list(due.values()), ledger, queue)
+            except HTTPError as e:
+                logger.error('%s: %s', e, e.response.text)
+            except (RequestException, UpstreamUnavailable) as e:
+                logger.error('Failed to send reminders: %s', e)
+
+        # Sleep until the next reminder is due or the next refresh, whichever is first
+        delay = next_refresh - time.monotonic()
+        if len(timers):
+            delay = min(delay, (timers[0][0] - datetime.datetime.now()).total_seconds())
+        time.sleep(max(delay, 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send Discord reminders for upcoming RCOS meetings.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and send each reminder at a fixed lead time instead of once for the next 2 hours')
+    args = parser.parse_args()
+    setup_logging()
+
+    queue = WebhookQueue()
+    with ReminderLedger() as ledger:
+        if args.daemon:
+            run_daemon(ledger, queue)
+        else:
+            try:
+                send_reminders(fetch_upcoming_meetings(), ledger, queue)
+            except HTTPError as e:
+                logger.error('%s: %s', e, e.response.text)
@@ -0,0 +1,161 @@
+'''Create or update users (and optionally their Discord account links) from a roster.
+
+The roster is a CSV file with a header row, or a JSONL file with one object per
+line, with the columns username, first_name, last_name and optionally
+graduation_year, role, timezone and discord_id. Rows are checked with the same
+rules as the join form and read as a stream, so memory use doesn't depend on the
+roster's size. Valid rows are upserted in chunks with one bulk request per table.
+Optional columns a row leaves empty keep the user's existing values.
+
+After every chunk, the number of rows done is saved to a checkpoint file. Running
+the same command again after an interruption continues from there. A chunk that
+PostgREST rejects is reported with its row numbers and skipped.
+
+Usage: python -m scripts.provision_users <roster.csv|roster.jsonl> [--chunk-size 500]
+                                         [--checkpoint PATH] [--restart] [--dry-run]
+'''
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from requests.exceptions import HTTPError
+
+from api import client
+from common.logs import setup_logging
+from portal.validation import InvalidUser, build_user
+
+logger = logging.getLogger(__name__)
+
+# Upsert on the primary key, keeping any columns a row doesn't set
+UPSERT_HEADERS = {'Prefer': 'resolution=merge-duplicates,return=minimal'}
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5
+
+
+def read_rows(path: str) -> Iterator[Dict]:
+    '''Stream the rows of a CSV or JSONL roster as dicts.'''
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def parse_row(row: Dict) -> Tuple[Dict, Optional[Dict]]:
+    '''Build the users row and, if the roster gives one, the Discord account row.'''
+    user = build_user(row.get('username') or '', row.get('first_name') or '', row.get('last_name') or '',
+                      row.get('timezone') or None, row.get('graduation_year') or None, row.get('role') or None)
+    discord_id = str(row.get('discord_id') or '').strip()
+    if discord_id and not discord_id.isdigit():
+        raise InvalidUser('discord_id must be a Discord user id.')
+    account = {'username': user['username'], 'type': 'discord', 'account_id': discord_id} if discord_id else None
+    return user, account
+
+
+def upsert(path: str, rows: List[Dict], on_conflict: str):
+    '''
+    Bulk upsert rows. PostgREST takes the columns from the rows, so rows that set
+    different columns (e.g. with and without a cohort) are sent separately rather
+    than having the missing ones overwritten with null.
+    '''
+    by_columns: Dict[Tuple[str, ...], List[Dict]] = {}
+    for row in rows:
+        by_columns.setdefault(tuple(sorted(row)), []).append(row)
+    for group in by_columns.values():
+        client.post(path, group, params={'on_conflict': on_conflict}, headers=UPSERT_HEADERS)
+
+
+def load_checkpoint(path: str) -> int:
+    try:
+        with open(path) as f:
+            return json.load(f)['rows']
+    except FileNotFoundError:
+        return 0
+
+
+def save_checkpoint(path: str, rows: int):
+    # Write to a temporary file first so a crash can't leave a half-written file
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'rows': rows}, f)
+    os.replace(path + '.tmp', path)
+
+
+def provision_users(roster_path: str, chunk_size: int = 500, checkpoint_path: Optional[str] = None,
+                    restart: bool = False, dry_run: bool = False):
+    checkpoint_path = checkpoint_path or roster_path + '.checkpoint'
+    skip = 0 if restart or dry_run else load_checkpoint(checkpoint_path)
+    if skip:
+        print(f'Resuming after row {skip} from {checkpoint_path}')
+
+    counts = {'rows': skip, 'users': 0, 'accounts': 0, 'invalid': 0, 'failed': 0}
+    started = last_progress = time.monotonic()
+    rows = enumerate(itertools.islice(read_rows(roster_path), skip, None), start=skip + 1)
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+
+        # Later rows for the same user win, since one request can't upsert a row twice
+        users: Dict[str, Dict] = {}
+        accounts: Dict[str, Dict] = {}
+        for number, row in chunk:
+            try:
+                user, account = parse_row(row)
+            except InvalidUser as err:
+                counts['invalid'] += 1
+                logger.warning('Skipping row %d: %s', number, err)
+                continue
+            users[user['username']] = user
+            if account is not None:
+                accounts[user['username']] = account
+
+        try:
+            if not dry_run:
+                # Users first since accounts reference them
+                upsert('/users', list(users.values()), 'username')
+                if accounts:
+                    upsert('/user_accounts', list(accounts.values()), 'username,type')
+        except HTTPError as err:
+            counts['failed'] += len(users)
+            logger.error('Failed to upsert rows %d-%d: %s: %s', chunk[0][0], chunk[-1][0], err, err.response.text)
+        else:
+            counts['users'] += len(users)
+            counts['accounts'] += len(accounts)
+        counts['rows'] = chunk[-1][0]
+        if not dry_run:
+            # Also after a failure, so resuming doesn't get stuck on the same chunk
+            save_checkpoint(checkpoint_path, chunk[-1][0])
+
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            print(f'{counts["rows"]} rows, {(counts["rows"] - skip) / (last_progress - started):.0f} rows/s')
+
+    elapsed = time.monotonic() - started
+    if not dry_run and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    print(f'{"Checked" if dry_run else "Provisioned"} {counts["users"]} users and {counts["accounts"]} Discord accounts '
+          f'from {counts["rows"] - skip} rows ({counts["invalid"]} invalid, {counts["failed"]} users failed) in {elapsed:.1f}s, '
+          f'{(counts["rows"] - skip) / elapsed if elapsed else 0:.0f} rows/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or update users from a CSV or JSONL roster.')
+    parser.add_argument('roster', help='path to a .csv (with a header row) or .jsonl file')
+    parser.add_argument('--chunk-size', type=int, default=500, help='rows upserted per request')
+    parser.add_argument('--checkpoint', help='where progress is saved (default: <roster>.checkpoint)')
+    parser.add_argument('--restart', action='store_true', help='ignore any saved progress and start over')
+    parser.add_argument('--dry-run', action='store_true', help='only check the rows')
+    args = parser.parse_args()
+    setup_logging()
+
+    provision_users(args.roster, args.chunk_size, args.checkpoint, args.restart, args.dry_run)
@@ -0,0 +1,71 @@
+'''A local, durable record of the meeting reminders that have been sent.
+
+Reminders are keyed by meeting id *and* start time, so a meeting is only announced
+once but a rescheduled meeting is announced again. Old entries are pruned whenever
+the ledger is opened, and daily by the reminder daemon.
+'''
+
+import datetime
+import os
+import sqlite3
+from typing import Iterable, List
+
+from dotenv import load_dotenv
+
+from api.models import Meeting
+
+load_dotenv()
+
+LEDGER_PATH = os.environ.get('REMINDER_LEDGER_PATH', 'reminders.sqlite3')
+
+# Entries for meetings that started longer ago than this are pruned
+RETENTION = datetime.timedelta(days=7)
+
+
+class ReminderLedger:
+    def __init__(self, path: str = LEDGER_PATH):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS sent_reminders (
+                    meeting_id TEXT NOT NULL,
+                    start_date_time TEXT NOT NULL,
+                    sent_at TEXT NOT NULL,
+                    PRIMARY KEY (meeting_id, start_date_time)
+                ) WITHOUT ROWID
+            ''')
+        self.prune()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def has_sent(self, meeting: Meeting) -> bool:
+        row = self.connection.execute(
+            'SELECT 1 FROM sent_reminders WHERE meeting_id = ? AND start_date_time = ?',
+            (str(meeting.meeting_id), meeting.start_date_time)).fetchone()
+        return row is not None
+
+    def unsent(self, meetings: Iterable[Meeting]) -> List[Meeting]:
+        '''Filter out the meetings that have already been reminded about.'''
+        return [meeting for meeting in meetings if not self.has_sent(meeting)]
+
+    def mark_sent(self, meetings: Iterable[Meeting]):
+        sent_at = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO sent_reminders VALUES (?, ?, ?)',
+                [(str(meeting.meeting_id), meeting.start_date_time, sent_at) for meeting in meetings])
+
+    def prune(self):
+        '''Forget reminders for meetings that started long enough ago.'''
+        # Start times are stored as ISO strings so they compare chronologically
+        cutoff = (datetime.datetime.now() - RETENTION).isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM sent_reminders WHERE start_date_time < ?', (cutoff,))
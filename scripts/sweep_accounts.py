@@ -0,0 +1,117 @@
+'''Delete Discord account links for users who are no longer on the server.
+
+The server's member list and the discord user_accounts rows are walked as two
+streams sorted by Discord user id and merge-joined, so memory use stays constant
+however many members and accounts there are. Orphaned rows are deleted in batches.
+
+Usage: python -m scripts.sweep_accounts [--dry-run]
+'''
+
+import argparse
+import itertools
+import logging
+from typing import Iterator, List
+
+from api import client, in_filter
+from api.models import UserAccount
+from common.logs import setup_logging
+from portal.discord import iter_members
+
+# Rows fetched per page and deleted per request
+PAGE_SIZE = 1000
+DELETE_BATCH_SIZE = 100
+
+# Discord ids are snowflakes, currently 17-19 digits long
+SNOWFLAKE_LENGTHS = range(15, 21)
+
+logger = logging.getLogger(__name__)
+
+
+def iter_discord_accounts() -> Iterator[UserAccount]:
+    '''
+    Go through the discord user_accounts rows in ascending numeric account_id order.
+    account_id is text, so rows are fetched one id length at a time (shorter numbers
+    are smaller) and paged by keyset within each length, where text order matches
+    numeric order.
+    '''
+    for length in SNOWFLAKE_LENGTHS:
+        last_account_id = ''
+        while True:
+            params = [
+                ('type', 'eq.discord'),
+                ('account_id', 'like.' + '_' * length),
+                ('select', 'username,account_id'),
+                ('order', 'account_id'),
+                ('limit', PAGE_SIZE)
+            ]
+            if last_account_id:
+                params.append(('account_id', 'gt.' + last_account_id))
+            accounts = client.get('/user_accounts', params=params, model=UserAccount)
+            yield from accounts
+            if len(accounts) < PAGE_SIZE:
+                break
+            last_account_id = accounts[-1].account_id
+
+
+def iter_orphaned_accounts(accounts: Iterator[UserAccount], member_ids: Iterator[int]) -> Iterator[UserAccount]:
+    '''Merge-join two streams sorted by Discord id, yielding the accounts with no member.'''
+    member_id = next(member_ids, None)
+    for account in accounts:
+        if not account.account_id.isdigit():
+            continue
+        account_id = int(account.account_id)
+        while member_id is not None and member_id < account_id:
+            member_id = next(member_ids, None)
+        if member_id != account_id:
+            yield account
+
+
+def delete_accounts(accounts: List[UserAccount]):
+    client.delete('/user_accounts', params={
+        'type': 'eq.discord',
+        'account_id': in_filter(account.account_id for account in accounts)
+    })
+
+
+def sweep_accounts(dry_run: bool = False):
+    counts = {'members': 0, 'accounts': 0, 'orphaned': 0, 'deleted': 0}
+
+    def count(key: str, stream: Iterator) -> Iterator:
+        for item in stream:
+            counts[key] += 1
+            yield item
+
+    members = count('members', (int(member['user']['id']) for member in iter_members()))
+    # An empty member list means something is wrong, not that everyone left
+    first_member = next(members, None)
+    if first_member is None:
+        logger.warning('No server members found, not deleting anything')
+        return
+    members = itertools.chain([first_member], members)
+    accounts = count('accounts', iter_discord_accounts())
+
+    batch = []
+    for account in iter_orphaned_accounts(accounts, members):
+        counts['orphaned'] += 1
+        print(f'{"Would delete" if dry_run else "Deleting"} account {account.account_id} of {account.username}')
+        batch.append(account)
+        if len(batch) == DELETE_BATCH_SIZE:
+            if not dry_run:
+                delete_accounts(batch)
+                counts['deleted'] += len(batch)
+            batch = []
+    if len(batch) and not dry_run:
+        delete_accounts(batch)
+        counts['deleted'] += len(batch)
+
+    print(f'Checked {counts["accounts"]} linked accounts against {counts["members"]} server members: '
+          f'{counts["orphaned"]} orphaned, {counts["deleted"]} deleted')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete Discord account links of users no longer on the server.')
+    parser.add_argument('--dry-run', action='store_true', help='only print the accounts that would be deleted')
+    args = parser.parse_args()
+    setup_logging()
+
+    sweep_accounts(args.dry_run)
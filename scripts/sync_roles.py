@@ -0,0 +1,170 @@
+'''Reconcile project and small group roles on the Discord server with enrollments.
+
+Loads a semester's enrollments, small groups, Discord account links and role chat
+associations in bulk, walks the server's member list a page at a time, and computes
+the role additions and removals needed for every member to have exactly the managed
+roles they should. Only roles that appear in chat associations are ever touched.
+
+Changes aren't applied when no one should have any managed role (e.g. a mistyped
+semester id) or when more than MAX_REMOVALS roles would be removed, unless --force
+is given.
+
+Usage: python -m scripts.sync_roles <semester_id> [--dry-run] [--force] [--workers N]
+'''
+
+import argparse
+import functools
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
+
+from requests import HTTPError
+
+from api import client
+from common.breaker import UpstreamUnavailable
+from common.logs import setup_logging
+from portal.discord import add_role_to_member, iter_members, remove_role_from_member
+
+# chat_associations.target_type of associations that point at Discord roles
+ROLE_TARGET_TYPE = 'discord_role'
+
+# Most role removals applied without --force
+MAX_REMOVALS = 100
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_role_associations(target_type: str = ROLE_TARGET_TYPE) -> Dict[Tuple[str, str], Set[str]]:
+    '''Get the role ids associated with each (source_type, source_id).'''
+    roles = defaultdict(set)
+    for association in client.get('/chat_associations', params={
+        'target_type': 'eq.' + target_type,
+        'select': 'source_type,source_id,target_id'
+    }):
+        roles[(association['source_type'], str(association['source_id']))].add(str(association['target_id']))
+    return roles
+
+
+def fetch_desired_roles(semester_id: str, roles: Dict[Tuple[str, str], Set[str]]) -> Dict[str, Set[str]]:
+    '''Compute the managed roles each user (by username) should have this semester.'''
+    enrollments = client.get('/enrollments', params={
+        'semester_id': 'eq.' + semester_id,
+        'select': 'username,project_id'
+    })
+    small_group_projects = client.get('/small_group_projects', params={
+        'small_groups.semester_id': 'eq.' + semester_id,
+        'select': 'small_group_id,project_id,small_groups!inner(semester_id)'
+    })
+    small_group_mentors = client.get('/small_group_mentors', params={
+        'small_groups.semester_id': 'eq.' + semester_id,
+        'select': 'small_group_id,username,small_groups!inner(semester_id)'
+    })
+
+    small_groups_by_project = defaultdict(set)
+    for row in small_group_projects:
+        small_groups_by_project[str(row['project_id'])].add(str(row['small_group_id']))
+
+    desired = defaultdict(set)
+    for enrollment in enrollments:
+        if enrollment['project_id'] is None:
+            continue
+        project_id = str(enrollment['project_id'])
+        desired[enrollment['username']] |= roles.get(('project', project_id), set())
+        for small_group_id in small_groups_by_project[project_id]:
+            desired[enrollment['username']] |= roles.get(('small_group', small_group_id), set())
+    for mentor in small_group_mentors:
+        desired[mentor['username']] |= roles.get(('small_group', str(mentor['small_group_id'])), set())
+    return desired
+
+
+def fetch_discord_usernames() -> Dict[str, str]:
+    '''Get the username linked to each Discord user id.'''
+    accounts = client.get('/user_accounts', params={
+        'type': 'eq.discord',
+        'select': 'username,account_id'
+    })
+    return {account['account_id']: account['username'] for account in accounts}
+
+
+def compute_changes(desired: Dict[str, Set[str]], usernames: Dict[str, str],
+                    managed_roles: Set[str]) -> List[Tuple[str, str, str]]:
+    '''
+    Walk the member list and diff each member's managed roles against the roles they
+    should have. Returns (member id, 'add' or 'remove', role id) operations.
+    '''
+    changes = []
+    for member in iter_members():
+        user_id = member['user']['id']
+        current = set(member['roles']) & managed_roles
+        should_have = desired.get(usernames.get(user_id), set())
+        changes.extend((user_id, 'add', role_id) for role_id in should_have - current)
+        changes.extend((user_id, 'remove', role_id) for role_id in current - should_have)
+    return changes
+
+
+def apply_change(stopped: threading.Event, change: Tuple[str, str, str]) -> bool:
+    '''Make one role change, unless Discord has become unavailable since the run started.'''
+    if stopped.is_set():
+        return False
+    user_id, action, role_id = change
+    try:
+        if action == 'add':
+            add_role_to_member(user_id, role_id)
+        else:
+            remove_role_from_member(user_id, role_id)
+        return True
+    except HTTPError as err:
+        logger.error('Failed to %s role %s for %s: %s', action, role_id, user_id, err)
+        return False
+    except UpstreamUnavailable as err:
+        if not stopped.is_set():
+            logger.error('Stopping, remaining role changes are skipped: %s', err)
+        stopped.set()
+        return False
+
+
+def sync_roles(semester_id: str, dry_run: bool = False, workers: int = 4, force: bool = False):
+    roles = fetch_role_associations()
+    managed_roles = set().union(*roles.values())
+    desired = fetch_desired_roles(semester_id, roles)
+    usernames = fetch_discord_usernames()
+    changes = compute_changes(desired, usernames, managed_roles)
+
+    for user_id, action, role_id in changes:
+        print(f'{"+" if action == "add" else "-"} {role_id} {usernames.get(user_id, "(not linked)")} ({user_id})')
+
+    additions = sum(1 for change in changes if change[1] == 'add')
+    print(f'{additions} role additions and {len(changes) - additions} role removals across {len(managed_roles)} managed roles')
+    if dry_run or len(changes) == 0:
+        return
+
+    removals = len(changes) - additions
+    if not force and not any(desired.values()):
+        logger.warning('No one should have any managed role in semester %s, not changing anything '
+                       '(use --force if that is right)', semester_id)
+        return
+    if not force and removals > MAX_REMOVALS:
+        logger.warning('Refusing to remove %d roles, more than %d (use --force if that is right)', removals, MAX_REMOVALS)
+        return
+
+    # The workers share portal.discord's rate limiter, so they never exceed a bucket
+    stopped = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        succeeded = sum(pool.map(functools.partial(apply_change, stopped), changes))
+    print(f'Applied {succeeded} of {len(changes)} role changes')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync project and small group roles on the Discord server.')
+    parser.add_argument('semester_id', help='e.g. 202101')
+    parser.add_argument('--dry-run', action='store_true', help='only print the changes that would be made')
+    parser.add_argument('--force', action='store_true',
+                        help=f'apply the changes even if no one should have any managed role or more than {MAX_REMOVALS} '
+                             'roles would be removed')
+    parser.add_argument('--workers', type=int, default=4, help='number of concurrent role changes')
+    args = parser.parse_args()
+    setup_logging()
+
+    sync_roles(args.semester_id, args.dry_run, args.workers, args.force)
@@ -0,0 +1,200 @@
+'''Sending Discord webhook messages while respecting their rate limits.
+
+Embeds bound for the same webhook are queued for a short window and packed into as
+few messages as possible (up to 10 embeds and 6000 characters per message).
+
+Discord docs: https://discord.com/developers/docs/resources/webhook#execute-webhook
+'''
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from dotenv import load_dotenv
+
+from common.http import session_for
+from common.ratelimit import RateLimiter
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How many webhooks are sent to at once
+WEBHOOK_CONCURRENCY = int(os.environ.get('WEBHOOK_CONCURRENCY', 4))
+
+# Seconds queued embeds wait for more embeds to the same webhook before being sent
+WEBHOOK_BATCH_WINDOW = float(os.environ.get('WEBHOOK_BATCH_WINDOW', 2))
+
+# How many times a message is retried after a 429 or 5xx response
+MAX_RETRIES = 5
+
+# Seconds to wait before the first retry after a 5xx, doubled for each retry after
+RETRY_BACKOFF = 1.0
+
+# Discord's limits on a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS = 6000
+
+# All webhooks share one route, with a bucket per webhook
+WEBHOOK_ROUTE = 'POST /webhooks/{webhook_id}/{webhook_token}'
+
+rate_limiter = RateLimiter()
+
+
+def webhook_id(url: str) -> str:
+    '''Get the id out of a webhook URL like https://discord.com/api/webhooks/<id>/<token>'''
+    return urlsplit(url).path.rstrip('/').split('/')[-2]
+
+
+def execute_webhook(url: str, payload: Dict) -> requests.Response:
+    '''
+    Send one webhook message, waiting out rate limits and retrying 429s and 5xx
+    errors with backoff. Raises for any error status left after retrying.
+    '''
+    major = webhook_id(url)
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire(WEBHOOK_ROUTE, major)
+        response = session_for(url).post(url, json=payload)
+        if attempt == MAX_RETRIES:
+            break
+        if response.status_code == 429:
+            retry_after = rate_limiter.rate_limited(WEBHOOK_ROUTE, major, response)
+            logger.info('Webhook rate limited, retrying in %.2fs', retry_after)
+        elif response.status_code >= 500:
+            retry_after = RETRY_BACKOFF * 2 ** attempt
+            logger.warning('Webhook failed with %d, retrying in %.2fs', response.status_code, retry_after)
+            time.sleep(retry_after)
+        else:
+            break
+
+    rate_limiter.update(WEBHOOK_ROUTE, major, response.headers)
+    response.raise_for_status()
+    return response
+
+
+def embed_length(embed: Dict) -> int:
+    '''Count the characters of an embed that go towards Discord's per-message limit.'''
+    length = len(embed.get('title') or '') + len(embed.get('description') or '')
+    length += len((embed.get('footer') or {}).get('text') or '')
+    length += len((embed.get('author') or {}).get('name') or '')
+    for field in embed.get('fields', []):
+        length += len(field['name']) + len(field['value'])
+    return length
+
+
+def pack_embeds(embeds: List[Dict]) -> List[List[Dict]]:
+    '''Split embeds, in order, into as few messages as Discord's limits allow.'''
+    messages = []
+    message, message_length = [], 0
+    for embed in embeds:
+        length = embed_length(embed)
+        if len(message) == MAX_EMBEDS_PER_MESSAGE or (len(message) and message_length + length > MAX_EMBED_CHARACTERS):
+            messages.append(message)
+            message, message_length = [], 0
+        message.append(embed)
+        message_length += length
+    if len(message):
+        messages.append(message)
+    return messages
+
+
+class DeliveryReport:
+    '''
+    Counts of messages delivered, embeds merged into a message with other embeds
+    (i.e. messages saved), and embeds dropped after their message failed.
+    '''
+
+    def __init__(self, delivered: int = 0, merged: int = 0, dropped: int = 0):
+        self.delivered = delivered
+        self.merged = merged
+        self.dropped = dropped
+
+    def add(self, other: 'DeliveryReport'):
+        self.delivered += other.delivered
+        self.merged += other.merged
+        self.dropped += other.dropped
+
+    def __str__(self):
+        return f'{self.delivered} messages delivered, {self.merged} embeds merged, {self.dropped} embeds dropped'
+
+
+class WebhookQueue:
+    '''
+    Collects embeds per webhook and sends them packed into as few messages as possible,
+    either once the batch window passes or when flushed. Each queued embed gets a Future
+    that resolves to the response of the message it was sent in, or to its error.
+    '''
+
+    def __init__(self, window: float = WEBHOOK_BATCH_WINDOW, max_workers: int = WEBHOOK_CONCURRENCY):
+        self.window = window
+        self.max_workers = max_workers
+        self.report = DeliveryReport()
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[Dict]] = {}
+        self._futures: Dict[str, List[Future]] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+        # Messages to one webhook are sent one at a time so they keep their order
+        self._send_locks: Dict[str, threading.Lock] = {}
+
+    def put(self, url: str, embed: Dict) -> Future:
+        future = Future()
+        with self._lock:
+            if url not in self._pending:
+                self._pending[url] = []
+                self._futures[url] = []
+                self._send_locks.setdefault(url, threading.Lock())
+                timer = self._timers[url] = threading.Timer(self.window, self.flush, [url])
+                timer.daemon = True
+                timer.start()
+            self._pending[url].append(embed)
+            self._futures[url].append(future)
+        return future
+
+    def flush(self, url: Optional[str] = None) -> DeliveryReport:
+        '''Send everything queued, for one webhook or for all. Returns what happened to it.'''
+        with self._lock:
+            urls = [url] if url is not None else list(self._pending)
+            batches = []
+            for batch_url in urls:
+                if batch_url not in self._pending:
+                    continue
+                self._timers.pop(batch_url).cancel()
+                batches.append((batch_url, self._pending.pop(batch_url), self._futures.pop(batch_url)))
+
+        report = DeliveryReport()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for batch_report in pool.map(lambda batch: self._send(*batch), batches):
+                report.add(batch_report)
+        with self._lock:
+            self.report.add(report)
+        return report
+
+    def _send(self, url: str, embeds: List[Dict], futures: List[Future]) -> DeliveryReport:
+        report = DeliveryReport()
+        with self._send_locks[url]:
+            i = 0
+            for message in pack_embeds(embeds):
+                message_futures = futures[i:i + len(message)]
+                i += len(message)
+                try:
+                    response = execute_webhook(url, {'embeds': message})
+                except requests.exceptions.RequestException as err:
+                    report.dropped += len(message)
+                    for future in message_futures:
+                        future.set_exception(err)
+                    continue
+                report.delivered += 1
+                report.merged += len(message) - 1
+                for future in message_futures:
+                    future.set_result(response)
+        return report
+
+    def close(self) -> DeliveryReport:
+        '''Send anything still queued. Returns the report for everything sent through the queue.'''
+        self.flush()
+        return self.report
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault('API_URL', 'http://postgrest.test')
+os.environ.setdefault('POSTGREST_JWT_SECRET', 'test-secret')
+
+from api import associations
+
+
+class FakeClient:
+    '''Serves chat_associations from a list, filtering by the eq. params.'''
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def matches(self, row, params):
+        return all(str(row[column]) == value[3:] for column, value in params.items())
+
+    async def get(self, path, params=None, headers=None, single=False, model=None):
+        rows = [row for row in self.rows if self.matches(row, params or {})]
+        return model.from_row(rows[0]) if single else model.from_rows(rows)
+
+    async def put(self, path, json, params=None, headers=None, model=None):
+        self.rows = [row for row in self.rows if not self.matches(row, params)] + [json]
+        return model.from_rows([json])
+
+
+class SetAssociationTest(unittest.TestCase):
+    def setUp(self):
+        associations.association_cache.invalidate_where(lambda key: True)
+        self.client = FakeClient([
+            {'source_type': 'project', 'source_id': 1, 'target_type': 'discord_role', 'target_id': '100'},
+            {'source_type': 'small_group', 'source_id': 2, 'target_type': 'discord_role', 'target_id': '200'},
+        ])
+        patcher = mock.patch.object(associations, 'async_client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_write_updates_lists_of_any_source_type(self):
+        before = asyncio.run(associations.list_associations(target_type='discord_role'))
+        self.assertEqual(sorted(a.target_id for a in before), ['100', '200'])
+
+        asyncio.run(associations.set_association('project', 'discord_role', 1, '101'))
+
+        after = asyncio.run(associations.list_associations(target_type='discord_role'))
+        self.assertEqual(sorted(a.target_id for a in after), ['101', '200'])
+
+    def test_write_updates_lists_by_source_id(self):
+        asyncio.run(associations.list_associations(source_id=1))
+        asyncio.run(associations.set_association('project', 'discord_role', 1, '101'))
+        after = asyncio.run(associations.list_associations(source_id=1))
+        self.assertEqual([a.target_id for a in after], ['101'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import unittest
+
+from common.logs import REDACTED, redact
+
+
+class RedactTest(unittest.TestCase):
+    def test_keeps_postgrest_error_codes(self):
+        body = '{"code":"23505","details":"Key (username)=(abc1) already exists.","hint":null,"message":"duplicate key"}'
+        self.assertEqual(redact(body), body)
+
+    def test_keeps_discord_error_codes(self):
+        body = '{"message": "Unknown Member", "code": 10007}'
+        self.assertEqual(redact(body), body)
+
+    def test_redacts_oauth_codes(self):
+        self.assertEqual(redact('GET /discord/callback?code=abc123&state=x'),
+                         f'GET /discord/callback?code={REDACTED}&state=x')
+        self.assertEqual(redact('grant_type=authorization_code&code=abc123'),
+                         f'grant_type=authorization_code&code={REDACTED}')
+
+    def test_redacts_tokens(self):
+        self.assertNotIn('secret-value', redact('{"access_token": "secret-value"}'))
+        self.assertNotIn('secret-value', redact('Authorization: Bot secret-value'))
+
+
+if __name__ == '__main__':
+    unittest.main()
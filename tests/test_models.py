@@ -0,0 +1,29 @@
+import os
+import unittest
+
+os.environ.setdefault('API_URL', 'http://postgrest.test')
+os.environ.setdefault('POSTGREST_JWT_SECRET', 'test-secret')
+
+from api.models import Meeting, RecordError, User, UserAccount
+
+
+class RecordTest(unittest.TestCase):
+    def test_pack_round_trip(self):
+        user = User.from_row({'username': 'abc1', 'first_name': 'A', 'cohort': 2020, 'unknown': 1})
+        self.assertEqual(User.unpack(user.pack()), user)
+
+    def test_missing_required_column(self):
+        with self.assertRaises(RecordError):
+            UserAccount.from_row({'username': 'abc1'})
+
+    def test_unpack_with_different_fields(self):
+        packed = Meeting.from_row({'meeting_id': 1, 'type': 'small_group', 'start_date_time': '2021-01-01T10:00:00',
+                                   'end_date_time': '2021-01-01T11:00:00', 'is_public': True}).pack()
+        with self.assertRaises(RecordError):
+            Meeting.unpack(packed[:-1])
+        with self.assertRaises(RecordError):
+            Meeting.unpack(packed + [None])
+
+
+if __name__ == '__main__':
+    unittest.main()